@@ -23,6 +23,14 @@ echo.
 echo Запуск системы...
 echo.
 
+REM Миграции схемы БД (сервер не стартует со старой схемой)
+python migrations.py
+if %errorlevel% neq 0 (
+    echo ❌ Ошибка миграции БД
+    pause
+    exit /b 1
+)
+
 python app.py
 
 pause
@@ -11,19 +11,29 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from models import db, Payment, Photo, Session, SessionPhoto
+from db_engine import configure_engine, database_url, engine_options, self_check
+from migrations import SchemaOutdated, check_schema
+from write_queue import init_write_queue, run_write
 from session_routes import init_session_routes
 
 app = Flask(__name__)
 CORS(app, origins=['http://localhost:5173'], supports_credentials=True)
 
-# Конфигурация базы данных SQLite
-basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(basedir, "photobooth.db")}'
+# Конфигурация базы данных: SQLite файл по умолчанию или DATABASE_URL
+# (PostgreSQL для центрального сервера на несколько фотобудок)
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Отдача фото через reverse proxy (Apache mod_xsendfile / lighttpd)
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '0') == '1'
+
 # Инициализация БД
 db.init_app(app)
 
+# Очередь записи с групповым commit (WRITE_QUEUE=1)
+init_write_queue(app)
+
 # ⚠️ ВАЖНО: Конфигурация для Payme и Click
 # ВАШИ РЕАЛЬНЫЕ ДАННЫЕ КАССЫ ФОТОБУДКИ
 PAYME_MERCHANT_ID = '670a6af1a048b8a82254e446'  # ✅ Ваша касса
@@ -56,23 +66,54 @@ def check_payme_auth():
         print(f"DEBUG: Auth check error: {e}", flush=True)
         return False
 
-# Создание таблиц при первом запуске
+def create_payment(**fields):
+    """Создать платёж через очередь записи, вернуть его (в сессии запроса)"""
+    def write():
+        payment = Payment(**fields)
+        db.session.add(payment)
+        db.session.flush()
+        return payment.id
+    
+    return Payment.query.get(run_write(write))
+
+def update_payment(payment, **values):
+    """Изменить поля платежа через очередь записи и перечитать объект"""
+    payment_id = payment.id
+    
+    def write():
+        target = Payment.query.get(payment_id)
+        for name, value in values.items():
+            setattr(target, name, value)
+    
+    run_write(write)
+    db.session.refresh(payment)
+
+# Проверка схемы: таблицы создаются и меняются только миграциями
 with app.app_context():
-    db.create_all()
-    print("Database tables created successfully!", flush=True)
-    print("✅ Tables: payments, photos, sessions, session_photos", flush=True)
+    # PRAGMA профиль SQLite (WAL, busy_timeout, ...) - до первого соединения
+    configure_engine(db.engine)
+    self_check(db.engine)
+    try:
+        schema = check_schema(db.engine)
+    except SchemaOutdated as e:
+        print(f"❌ {e}", flush=True)
+        raise SystemExit(1)
+    print(f"✅ Database schema version {schema}", flush=True)
 
 # Инициализация роутов для сессий
 init_session_routes(app)
 
+DATABASE_NAMES = {'sqlite': 'SQLite', 'postgresql': 'PostgreSQL'}
+
 @app.route('/api/test', methods=['GET'])
 def test():
     # Подсчитаем количество платежей в БД
     payment_count = Payment.query.count()
+    database = DATABASE_NAMES.get(db.engine.dialect.name, db.engine.dialect.name)
     return jsonify({
         'status': 'OK', 
-        'message': 'Photobooth payment API working with SQLite',
-        'database': 'SQLite',
+        'message': f'Photobooth payment API working with {database}',
+        'database': database,
         'payments_count': payment_count
     })
 
@@ -92,7 +133,7 @@ def generate_qr():
     
     if not existing_payment:
         try:
-            payment = Payment(
+            payment = create_payment(
                 order_id=order_id,
                 transaction_id=None,  # Будет заполнено при webhook
                 amount=int(float(amount)),
@@ -101,8 +142,6 @@ def generate_qr():
                 state=0,  # 0 = создан, ожидает оплаты
                 create_time=datetime.utcnow()
             )
-            db.session.add(payment)
-            db.session.commit()
             print(f"DEBUG: Created payment record for {payment_type}: order_id={order_id}, id={payment.id}", flush=True)
         except Exception as e:
             db.session.rollback()
@@ -247,12 +286,12 @@ def payme_webhook():
             # ✅ ОБНОВЛЕНИЕ: Привязываем transaction_id к существующему платежу
             print(f"DEBUG: Updating payment: order_id={order_id} with transaction_id={transaction_id}", flush=True)
             
-            payment.transaction_id = transaction_id
-            payment.state = 1  # created
-            if not payment.create_time:
-                payment.create_time = datetime.utcnow()
-            
-            db.session.commit()
+            update_payment(
+                payment,
+                transaction_id=transaction_id,
+                state=1,  # created
+                create_time=payment.create_time or datetime.utcnow()
+            )
             
             print(f"DEBUG: ✅ Payment updated successfully: order_id={order_id}, transaction_id={transaction_id}", flush=True)
             
@@ -286,10 +325,7 @@ def payme_webhook():
             })
         
         # Обновляем статус на success
-        payment.status = 'success'
-        payment.state = 2
-        payment.perform_time = datetime.utcnow()
-        db.session.commit()
+        update_payment(payment, status='success', state=2, perform_time=datetime.utcnow())
         
         print(f"DEBUG: Payment success for order_id={payment.order_id}", flush=True)
         
@@ -308,10 +344,7 @@ def payme_webhook():
         payment = Payment.query.filter_by(transaction_id=transaction_id).first()
         
         if payment:
-            payment.status = 'canceled'
-            payment.state = -2
-            payment.cancel_time = datetime.utcnow()
-            db.session.commit()
+            update_payment(payment, status='canceled', state=-2, cancel_time=datetime.utcnow())
             print(f"DEBUG: Payment canceled: {payment}", flush=True)
         
         return jsonify({
@@ -437,13 +470,12 @@ def click_prepare():
         if payment:
             print(f"DEBUG: Found payment with different type: {payment.payment_type}, updating to 'click'", flush=True)
             # Обновляем payment_type на правильный
-            payment.payment_type = 'click'
-            db.session.commit()
+            update_payment(payment, payment_type='click')
         else:
             # Заказ не найден вообще - создаём новый (защита от race condition)
             print(f"DEBUG: Order not found, creating new: {merchant_trans_id}", flush=True)
             try:
-                payment = Payment(
+                payment = create_payment(
                     order_id=merchant_trans_id,
                     transaction_id=None,  # Будет установлен ниже
                     amount=int(float(amount)),
@@ -452,8 +484,6 @@ def click_prepare():
                     state=0,
                     create_time=datetime.utcnow()
                 )
-                db.session.add(payment)
-                db.session.commit()
                 print(f"DEBUG: Created new payment in prepare: payment_id={payment.id}", flush=True)
             except Exception as e:
                 db.session.rollback()
@@ -471,16 +501,13 @@ def click_prepare():
     if payment.amount and int(float(amount)) != int(payment.amount):
         print(f"DEBUG: WARNING - Amount mismatch: expected={payment.amount}, got={amount}", flush=True)
         # Обновляем сумму на актуальную из Click
-        payment.amount = int(float(amount))
-        db.session.commit()
+        update_payment(payment, amount=int(float(amount)))
         print(f"DEBUG: Updated amount to {payment.amount}", flush=True)
     
     # Обновляем transaction_id и state если это первый prepare
     if not payment.transaction_id:
         try:
-            payment.transaction_id = click_trans_id
-            payment.state = 1  # 1 = prepare выполнен
-            db.session.commit()
+            update_payment(payment, transaction_id=click_trans_id, state=1)  # 1 = prepare выполнен
             print(f"DEBUG: Updated payment with transaction_id: payment_id={payment.id}, click_trans_id={click_trans_id}", flush=True)
         except Exception as e:
             db.session.rollback()
@@ -564,10 +591,7 @@ def click_complete():
     # Проверка на ошибку от Click
     if error and str(error) != "0":
         print(f"DEBUG: Click error received: error={error}", flush=True)
-        payment.status = 'failed'
-        payment.state = -1
-        payment.cancel_time = datetime.utcnow()
-        db.session.commit()
+        update_payment(payment, status='failed', state=-1, cancel_time=datetime.utcnow())
         return jsonify({
             "error": -9,
             "error_note": "Payment failed on Click side",
@@ -579,10 +603,7 @@ def click_complete():
     # Action = 0 означает отмена
     if str(action) == "0":
         print(f"DEBUG: Transaction canceled: payment_id={payment.id}", flush=True)
-        payment.status = 'canceled'
-        payment.state = -2
-        payment.cancel_time = datetime.utcnow()
-        db.session.commit()
+        update_payment(payment, status='canceled', state=-2, cancel_time=datetime.utcnow())
         return jsonify({
             "error": 0,
             "error_note": "Canceled",
@@ -605,10 +626,7 @@ def click_complete():
             })
         
         # Обновляем статус на success
-        payment.status = 'success'
-        payment.state = 2
-        payment.perform_time = datetime.utcnow()
-        db.session.commit()
+        update_payment(payment, status='success', state=2, perform_time=datetime.utcnow())
         
         print(f"DEBUG: Payment success for order_id={payment.order_id}", flush=True)
         
@@ -637,7 +655,7 @@ def test_payment(order_id):
     payment = Payment.query.filter_by(order_id=order_id).first()
     
     if not payment:
-        payment = Payment(
+        payment = create_payment(
             order_id=order_id,
             transaction_id=f'test-{order_id}',
             amount=10000,
@@ -646,12 +664,8 @@ def test_payment(order_id):
             create_time=datetime.utcnow(),
             perform_time=datetime.utcnow()
         )
-        db.session.add(payment)
     else:
-        payment.status = 'success'
-        payment.perform_time = datetime.utcnow()
-    
-    db.session.commit()
+        update_payment(payment, status='success', perform_time=datetime.utcnow())
     
     print(f"DEBUG: Test payment success for order_id={order_id}", flush=True)
     return jsonify({'status': 'ok', 'message': 'Payment simulated successfully', 'payment': payment.to_dict()})
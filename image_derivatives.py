@@ -0,0 +1,276 @@
+"""
+Превью и другие производные версии фото (resize + перекодирование)
+
+Каждая производная (размер, fit, формат, качество) генерируется один раз
+и кладётся в дисковый кэш с лимитом размера. При переполнении удаляются
+файлы, к которым дольше всего не обращались (LRU по mtime).
+
+Формат можно указать явно (?format=webp) или выбрать по заголовку Accept:
+AVIF (если Pillow умеет его кодировать), WebP, иначе прогрессивный JPEG.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from image_pipeline import ROTATED_ORIENTATIONS, exif_orientation
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+DERIVATIVE_CACHE_DIR = os.getenv('DERIVATIVE_CACHE_DIR', os.path.join(basedir, 'storage', 'derivatives'))
+DERIVATIVE_CACHE_MAX_BYTES = int(os.getenv('DERIVATIVE_CACHE_MAX_MB', '512')) * 1024 * 1024
+
+# Ограничения параметров (чтобы нельзя было заказать превью 50000px)
+MAX_DIMENSION = 4096
+DEFAULT_QUALITY = 80
+
+FITS = ('contain', 'cover', 'fill')
+
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'png': ('PNG', 'image/png', 'png'),
+}
+
+# AVIF: встроен в новые Pillow или добавляется плагином pillow-avif-plugin
+try:
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+Image.init()
+if 'AVIF' in Image.SAVE:
+    FORMATS['avif'] = ('AVIF', 'image/avif', 'avif')
+
+# Форматы, которые выбираются по Accept (в порядке предпочтения)
+NEGOTIATED_FORMATS = ('avif', 'webp')
+
+
+def negotiate_format(accept, fallback='jpeg'):
+    """Лучший формат из тех, что клиент явно перечислил в Accept
+
+    accept - пары (mime, q), например request.accept_mimetypes.
+    */* не считается: боты и curl шлют его, но ждут обычный JPEG.
+    """
+    offered = {value.lower() for value, quality in accept if quality > 0}
+    for fmt in NEGOTIATED_FORMATS:
+        if fmt in FORMATS and FORMATS[fmt][1] in offered:
+            return fmt
+    return fallback
+
+
+def parse_format(args, accept=()):
+    """Формат из ?format= или из Accept (format=auto или не указан)
+
+    Возвращает (format, negotiated). Бросает ValueError при неизвестном формате
+    """
+    fmt = (args.get('format') or 'auto').lower()
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt == 'auto':
+        return negotiate_format(accept), True
+    if fmt not in FORMATS:
+        raise ValueError(f'format must be one of: auto, {", ".join(FORMATS)}')
+    return fmt, False
+
+
+def parse_params(args, accept=(), require_size=True):
+    """Параметры производной из query string (w, h, fit, format, quality)
+
+    Без w и h (require_size=False) - перекодирование в полном размере.
+    params['negotiated'] - формат выбран по Accept (нужен Vary: Accept).
+    Бросает ValueError при некорректных значениях
+    """
+    try:
+        width = int(args['w']) if args.get('w') else None
+        height = int(args['h']) if args.get('h') else None
+        quality = int(args.get('quality', DEFAULT_QUALITY))
+    except ValueError:
+        raise ValueError('w, h and quality must be integers')
+
+    if require_size and width is None and height is None:
+        raise ValueError('w or h is required')
+
+    for value in (width, height):
+        if value is not None and not 1 <= value <= MAX_DIMENSION:
+            raise ValueError(f'w and h must be between 1 and {MAX_DIMENSION}')
+
+    if not 1 <= quality <= 95:
+        raise ValueError('quality must be between 1 and 95')
+
+    fit = args.get('fit', 'contain')
+    if fit not in FITS:
+        raise ValueError(f'fit must be one of: {", ".join(FITS)}')
+
+    fmt, negotiated = parse_format(args, accept)
+
+    return {'w': width, 'h': height, 'fit': fit, 'format': fmt, 'quality': quality, 'negotiated': negotiated}
+
+
+def render(data, params):
+    """Сгенерировать производную из байтов исходного фото"""
+    img = Image.open(BytesIO(data))
+    icc_profile = img.info.get('icc_profile')
+    orientation = exif_orientation(img)
+    rotated = orientation in ROTATED_ORIENTATIONS
+    src_w, src_h = img.size
+    if rotated:
+        src_w, src_h = src_h, src_w
+
+    size = None
+    if params['w'] or params['h']:
+        width = params['w'] or max(1, round(src_w * params['h'] / src_h))
+        height = params['h'] or max(1, round(src_h * params['w'] / src_w))
+        size = (width, height)
+
+        # JPEG можно декодировать сразу в уменьшенном масштабе (1/2, 1/4, 1/8).
+        # draft работает с размерами как они записаны в файле - до поворота
+        img.draft('RGB', (height, width) if rotated else size)
+
+    if orientation != 1:
+        img = ImageOps.exif_transpose(img)
+
+    if size:
+        if params['fit'] == 'cover':
+            img = ImageOps.fit(img, size, Image.Resampling.LANCZOS)
+        elif params['fit'] == 'fill':
+            img = img.resize(size, Image.Resampling.LANCZOS)
+        else:
+            img.thumbnail(size, Image.Resampling.LANCZOS)
+
+    pil_format, _, _ = FORMATS[params['format']]
+    if pil_format in ('JPEG', 'AVIF') and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+
+    buffer = BytesIO()
+    if pil_format == 'PNG':
+        img.save(buffer, format=pil_format, optimize=True, icc_profile=icc_profile)
+    elif pil_format == 'JPEG':
+        # Прогрессивный JPEG меньше и на экране появляется сразу целиком
+        img.save(buffer, format=pil_format, quality=params['quality'],
+                 progressive=True, optimize=True, icc_profile=icc_profile)
+    else:
+        img.save(buffer, format=pil_format, quality=params['quality'], icc_profile=icc_profile)
+    return buffer.getvalue()
+
+
+class DerivativeCache:
+    """Дисковый кэш производных с лимитом размера и LRU вытеснением
+
+    Блокировки и учёт размера - в пределах процесса (см. db_engine про
+    несколько worker-процессов).
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._size = None  # считаем лениво при первой записи
+
+    @staticmethod
+    def key_for(source_digest, params):
+        raw = f"{source_digest}:{params['w']}x{params['h']}:{params['fit']}:{params['format']}:{params['quality']}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def path(self, key, fmt):
+        return os.path.join(self.root, key[:2], f"{key}.{FORMATS[fmt][2]}")
+
+    def get(self, key, fmt):
+        """Путь к закэшированной производной или None"""
+        path = self.path(key, fmt)
+        try:
+            # Обновляем mtime - это и есть "время последнего обращения" для LRU
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            return None
+
+    def get_or_create(self, key, fmt, factory):
+        """Вернуть путь к производной, сгенерировав её через factory() если нужно
+
+        Параллельные запросы одной и той же производной ждут друг друга,
+        поэтому картинка генерируется один раз. Файл может быть вытеснен
+        до того, как вызывающий его откроет (FileNotFoundError) - тогда
+        достаточно вызвать get_or_create ещё раз.
+        """
+        path = self.get(key, fmt)
+        if path:
+            return path
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            path = self.get(key, fmt)
+            if not path:
+                path = self._put(key, fmt, factory())
+
+        with self._lock:
+            self._key_locks.pop(key, None)
+
+        return path
+
+    def _put(self, key, fmt, data):
+        path = self.path(key, fmt)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, _, size in self._entries())
+            else:
+                self._size += len(data)
+
+            if self._size > self.max_bytes:
+                self._evict(keep=path)
+
+        return path
+
+    def _entries(self):
+        """(mtime, path, size) всех файлов кэша"""
+        if not os.path.isdir(self.root):
+            return []
+        entries = []
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith('.tmp-'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def _evict(self, keep=None):
+        """Удалять самые старые производные пока кэш не влезет в лимит"""
+        evicted = 0
+        for _, path, size in sorted(self._entries()):
+            if self._size <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                continue  # Windows: файл сейчас отправляется клиенту
+            self._size -= size
+            evicted += 1
+
+        if evicted:
+            print(f"🧹 Derivative cache: evicted {evicted} files", flush=True)
+
+
+derivative_cache = DerivativeCache(DERIVATIVE_CACHE_DIR, DERIVATIVE_CACHE_MAX_BYTES)
@@ -0,0 +1,548 @@
+"""
+Обработка загруженных фото (нормализация в JPEG) в пуле процессов
+
+Декодирование, перевод в RGB, уменьшение до 4096px и перекодирование
+в JPEG выполняются в отдельных процессах, чтобы не занимать GIL потока
+бота и Flask API. Очередь задач ограничена, у каждой задачи есть таймаут.
+
+HEIC/HEIF (iPhone) и AVIF декодируются через pillow-heif, если он установлен.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from io import BytesIO
+
+from PIL import ExifTags, Image, UnidentifiedImageError
+
+try:
+    from PIL import ImageCms
+except ImportError:  # Pillow собран без littlecms
+    ImageCms = None
+
+# Регистрируется при импорте модуля - в том числе в процессах-воркерах
+try:
+    import pillow_heif
+except ImportError:
+    pillow_heif = None
+else:
+    pillow_heif.register_heif_opener()
+    if hasattr(pillow_heif, 'register_avif_opener') and 'AVIF' not in Image.OPEN:
+        pillow_heif.register_avif_opener()
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# ============================================
+# КОНФИГУРАЦИЯ
+# ============================================
+
+# 0 - обрабатывать в текущем процессе (без пула)
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', str(os.cpu_count() or 1)))
+IMAGE_QUEUE_SIZE = int(os.getenv('IMAGE_QUEUE_SIZE', str(max(IMAGE_WORKERS, 1) * 2)))
+IMAGE_JOB_TIMEOUT = float(os.getenv('IMAGE_JOB_TIMEOUT', '30'))
+# Файловый объект до этого размера уходит в воркер байтами, больше -
+# через собственную временную копию на диске
+IMAGE_POOL_INLINE_BYTES = int(float(os.getenv('IMAGE_POOL_INLINE_MB', '2')) * 1024 * 1024)
+
+MAX_SIZE = 4096
+JPEG_QUALITY = 95
+
+# Бюджет размера JPEG: подбираем максимальное качество, при котором файл
+# влезает в бюджет, но не ниже JPEG_QUALITY_FLOOR (0 - без бюджета,
+# всегда JPEG_QUALITY). 10x15 при 300 dpi хватает ~2 МБ
+JPEG_BUDGET_BYTES = int(float(os.getenv('JPEG_BUDGET_KB', '2048')) * 1024)
+JPEG_QUALITY_FLOOR = int(os.getenv('JPEG_QUALITY_FLOOR', '80'))
+
+# Бюджет пикселей на одно загружаемое изображение (защита от
+# decompression bomb). Проверяется только здесь, глобальный
+# Image.MAX_IMAGE_PIXELS не меняем - он защищает и превью, и печать.
+# Больше лимита Pillow (~89 Мп) всё равно не пропустит проверка в open()
+IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', str(Image.MAX_IMAGE_PIXELS)))
+
+# Готовые JPEG (RGB, <= MAX_SIZE, без поворота и EXIF/XMP, в бюджете)
+# сохраняются как есть, без декодирования и перекодирования
+IMAGE_PASSTHROUGH = os.getenv('IMAGE_PASSTHROUGH', '1') == '1'
+
+# Во сколько раз итоговый размер может быть меньше промежуточного:
+# сначала быстрое уменьшение reduce(), затем точный LANCZOS
+IMAGE_REDUCING_GAP = float(os.getenv('IMAGE_REDUCING_GAP', '3.0'))
+
+# Режим измерения: время декодирования и память по каждому фото
+IMAGE_MEASURE = os.getenv('IMAGE_MEASURE', '0') == '1'
+
+
+# EXIF Orientation -> как повернуть картинку (как в ImageOps.exif_transpose)
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def exif_orientation(img):
+    """EXIF Orientation открытой картинки (1 - поворачивать не нужно)
+
+    Новые загрузки уже повёрнуты при приёме, но старые base64 строки,
+    перенесённые migrate_photos.py файлы и фото через API хранятся как
+    прислали - им поворот нужен при каждом рендере.
+    """
+    try:
+        return img.getexif().get(ExifTags.Base.Orientation) or 1
+    except Exception:
+        return 1  # битый EXIF - как без поворота
+
+
+class ImageTooLarge(ValueError):
+    """Изображение превышает бюджет пикселей"""
+
+
+class UnsupportedImage(ValueError):
+    """Формат файла не распознан (например, HEIC без pillow-heif)"""
+
+
+class PipelineBusy(Exception):
+    """Очередь обработки переполнена"""
+
+
+class PipelineTimeout(Exception):
+    """Обработка фото не уложилась в таймаут"""
+
+
+# ============================================
+# НОРМАЛИЗАЦИЯ (выполняется в процессе-воркере)
+# ============================================
+
+def _peak_rss_mb():
+    """Пиковый RSS текущего процесса в МБ (None если не поддерживается)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КБ, macOS - байты
+    return round(peak / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
+
+
+def _exif_datetime(value):
+    """'2024:05:01 12:30:00' -> '2024-05-01T12:30:00' (или None)"""
+    try:
+        return datetime.strptime(str(value).strip('\x00 '), '%Y:%m:%d %H:%M:%S').isoformat()
+    except ValueError:
+        return None
+
+
+def _color_space(img, exif_ifd):
+    """Цветовое пространство: описание ICC профиля, EXIF ColorSpace или режим"""
+    icc_profile = img.info.get('icc_profile')
+    if icc_profile and ImageCms is not None:
+        try:
+            description = ImageCms.getProfileDescription(ImageCms.ImageCmsProfile(BytesIO(icc_profile)))
+            return description.strip()[:50] or 'ICC'
+        except Exception:
+            return 'ICC'
+    if icc_profile:
+        return 'ICC'
+    if exif_ifd.get(ExifTags.Base.ColorSpace) == 1:
+        return 'sRGB'
+    return img.mode
+
+
+def read_metadata(img):
+    """Метаданные оригинала: ориентация, размеры, время съёмки, цвет
+
+    original_width/original_height - размеры оригинала с учётом ориентации
+    (как его видит человек), а не как они записаны в файле.
+    """
+    exif = img.getexif()
+    exif_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+    orientation = exif.get(ExifTags.Base.Orientation) or 1
+
+    width, height = img.size
+    if orientation in ROTATED_ORIENTATIONS:
+        width, height = height, width
+
+    taken_at = exif_ifd.get(ExifTags.Base.DateTimeOriginal) or exif.get(ExifTags.Base.DateTime)
+
+    return {
+        'orientation': orientation,
+        'original_width': width,
+        'original_height': height,
+        'taken_at': _exif_datetime(taken_at) if taken_at else None,
+        'color_space': _color_space(img, exif_ifd),
+    }
+
+
+def _encode_jpeg(img, quality, subsampling, icc_profile):
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=quality, subsampling=subsampling, icc_profile=icc_profile)
+    return buffer.getvalue()
+
+
+def encode_jpeg(img, icc_profile=None, budget=JPEG_BUDGET_BYTES, floor=JPEG_QUALITY_FLOOR):
+    """Закодировать JPEG в бюджет байтов, возвращает (data, quality, subsampling)
+
+    Сначала JPEG_QUALITY с полным цветом (4:4:4), затем 4:2:0 и бинарный
+    поиск максимального качества в [floor, JPEG_QUALITY]. Если даже floor
+    не влезает - берём floor: качество важнее бюджета. Все попытки
+    кодируют одну и ту же декодированную картинку.
+    """
+    data = _encode_jpeg(img, JPEG_QUALITY, '4:4:4', icc_profile)
+    if not budget or len(data) <= budget:
+        return data, JPEG_QUALITY, '4:4:4'
+
+    best = None
+    low, high = min(floor, JPEG_QUALITY), JPEG_QUALITY
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = _encode_jpeg(img, quality, '4:2:0', icc_profile)
+        if len(candidate) <= budget:
+            best = (candidate, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    if best is None:
+        quality = min(floor, JPEG_QUALITY)
+        best = (_encode_jpeg(img, quality, '4:2:0', icc_profile), quality)
+
+    return best[0], best[1], '4:2:0'
+
+
+def _to_rgb(img, icc_profile):
+    """Привести к RGB, возвращает (img, icc_profile) для выходного файла
+
+    Профиль описывает исходный режим: CMYK/серый профиль в RGB JPEG
+    просмотрщики либо игнорируют, либо применяют к чужим каналам. Поэтому
+    он остаётся только если режим не менялся; CMYK с профилем переводим
+    через ImageCms в sRGB, иначе профиль просто отбрасываем.
+    """
+    if img.mode == 'RGB':
+        return img, icc_profile
+
+    if img.mode == 'CMYK' and icc_profile and ImageCms is not None:
+        try:
+            img = ImageCms.profileToProfile(
+                img, ImageCms.ImageCmsProfile(BytesIO(icc_profile)), ImageCms.createProfile('sRGB'),
+                outputMode='RGB',
+            )
+            return img, None
+        except Exception as e:
+            print(f"⚠️ ICC conversion failed, falling back to convert('RGB'): {e}", flush=True)
+
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+        img = background
+    else:
+        img = img.convert('RGB')
+    return img, None
+
+
+def can_pass_through(img, byte_size, metadata):
+    """Можно ли сохранить файл без изменений (проверяется только заголовок)
+
+    EXIF/XMP должны отсутствовать: в них бывают GPS и миниатюры, которые
+    при перекодировании удаляются. Сжатые Telegram "фото" их не содержат.
+    """
+    return (
+        IMAGE_PASSTHROUGH
+        and img.format == 'JPEG'
+        and img.mode == 'RGB'
+        and max(img.size) <= MAX_SIZE
+        and metadata['orientation'] == 1
+        and not img.info.get('exif')
+        and not img.info.get('xmp')
+        and (not JPEG_BUDGET_BYTES or byte_size <= JPEG_BUDGET_BYTES)
+    )
+
+
+@contextmanager
+def _source_file(source):
+    """bytes, путь к файлу или файловый объект -> файловый объект с начала"""
+    if isinstance(source, (bytes, bytearray)):
+        yield BytesIO(source)
+    elif isinstance(source, str):
+        with open(source, 'rb') as f:
+            yield f
+    else:
+        source.seek(0)
+        yield source
+
+
+def normalize_upload(source, measure=IMAGE_MEASURE):
+    """Привести загруженное изображение к JPEG (RGB, макс 4096px)
+
+    source - bytes, путь к файлу или файловый объект (например,
+    SpooledTemporaryFile): файл декодируется прямо с диска без копии в памяти.
+
+    Большие JPEG декодируются сразу в уменьшенном масштабе (draft/DCT
+    scaling), остаток уменьшения делает resize с reducing_gap.
+    EXIF ориентация применяется здесь один раз: сохранённые пиксели уже
+    повёрнуты правильно, а EXIF/XMP/миниатюры из файла удаляются
+    (ICC профиль остаётся). Качество JPEG подбирается под
+    JPEG_BUDGET_BYTES (metadata['encode_quality']).
+
+    Если файл уже подходит (can_pass_through), возвращаются исходные
+    байты без декодирования, result['passthrough'] = True.
+
+    Возвращает {'data': bytes, 'width': int, 'height': int, 'metadata': dict},
+    а в режиме измерения ещё и 'stats' (время декодирования и память).
+    """
+    with _source_file(source) as fp:
+        return _normalize(fp, measure)
+
+
+def _normalize(fp, measure):
+    started = time.perf_counter()
+    byte_size = fp.seek(0, os.SEEK_END)
+    fp.seek(0)
+
+    # Защита от decompression bomb: PIL проверяет размер по заголовку,
+    # до декодирования; предупреждение превращаем в ошибку
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', Image.DecompressionBombWarning)
+            img = Image.open(fp)
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+        raise ImageTooLarge(str(e))
+    except UnidentifiedImageError as e:
+        raise UnsupportedImage(str(e))
+    source_size = img.size
+    if source_size[0] * source_size[1] > IMAGE_MAX_PIXELS:
+        raise ImageTooLarge(
+            f'Image size ({source_size[0] * source_size[1]} pixels) exceeds limit of {IMAGE_MAX_PIXELS} pixels'
+        )
+    metadata = read_metadata(img)
+
+    if can_pass_through(img, byte_size, metadata):
+        width, height = img.size
+        metadata['encode_quality'] = None
+        fp.seek(0)
+        data = fp.read()
+        result = {'data': data, 'width': width, 'height': height, 'metadata': metadata, 'passthrough': True}
+        if measure:
+            result['stats'] = {
+                'source_size': source_size,
+                'passthrough': True,
+                'total_ms': round((time.perf_counter() - started) * 1000, 1),
+                'output_kb': round(len(data) / 1024, 1),
+                'peak_rss_mb': _peak_rss_mb(),
+            }
+        return result
+
+    # Целевой размер после уменьшения до MAX_SIZE (в координатах файла,
+    # поворот по EXIF делается уже на уменьшенной картинке)
+    ratio = min(1.0, MAX_SIZE / max(source_size))
+    target_size = tuple(max(1, int(dim * ratio)) for dim in source_size)
+
+    # JPEG: декодер сразу отдаёт картинку в 1/2, 1/4 или 1/8 размера,
+    # но не меньше target_size (для остальных форматов это no-op)
+    if ratio < 1.0:
+        img.draft('RGB', target_size)
+
+    img.load()
+    decoded_at = time.perf_counter()
+    decoded_size = img.size
+    decoded_bytes = img.size[0] * img.size[1] * len(img.getbands())
+    icc_profile = img.info.get('icc_profile')
+
+    # HEIF/PNG и др. не умеют декодировать в уменьшенном масштабе:
+    # сразу уменьшаем в целое число раз (reduce - быстрое усреднение
+    # блоков), чтобы полноразмерная копия не жила дальше этой строки
+    factor = int(min(img.size[0] / target_size[0], img.size[1] / target_size[1]) / IMAGE_REDUCING_GAP)
+    if factor > 1:
+        img = img.reduce(factor)
+
+    # Конвертируем в RGB если нужно
+    img, icc_profile = _to_rgb(img, icc_profile)
+
+    # Изменяем размер если очень большое (макс 4096px)
+    if img.size != target_size:
+        img = img.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=IMAGE_REDUCING_GAP)
+
+    # Поворот по EXIF - один раз, дальше все используют готовые пиксели
+    transpose = ORIENTATION_TRANSPOSE.get(metadata['orientation'])
+    if transpose is not None:
+        img = img.transpose(transpose)
+
+    # EXIF и XMP не передаём - в файл попадает только ICC профиль
+    encode_started = time.perf_counter()
+    output, quality, subsampling = encode_jpeg(img, icc_profile)
+    metadata['encode_quality'] = quality
+
+    width, height = img.size
+    result = {'data': output, 'width': width, 'height': height, 'metadata': metadata, 'passthrough': False}
+
+    if measure:
+        result['stats'] = {
+            'source_size': source_size,
+            'passthrough': False,
+            'decoded_size': decoded_size,
+            'decode_ms': round((decoded_at - started) * 1000, 1),
+            'total_ms': round((time.perf_counter() - started) * 1000, 1),
+            'decoded_mb': round(decoded_bytes / 1024 / 1024, 1),
+            'encode_ms': round((time.perf_counter() - encode_started) * 1000, 1),
+            'encode_quality': quality,
+            'encode_subsampling': subsampling,
+            'output_kb': round(len(output) / 1024, 1),
+            'peak_rss_mb': _peak_rss_mb(),
+        }
+
+    return result
+
+
+# ============================================
+# ПУЛ ПРОЦЕССОВ
+# ============================================
+
+def _pool_source(source):
+    """Аргумент для процесса-воркера: (bytes или путь, временный файл или None)
+
+    Файловые объекты не передаются между процессами. Небольшой файл
+    передаём байтами, большой копируем в свой временный файл, который
+    удаляется после обработки. Путь исходного объекта (.name) не
+    используем: временный файл Windows (O_TEMPORARY) другой процесс
+    открыть не может, а после закрытия его уже нет.
+    """
+    if isinstance(source, (bytes, bytearray, str)):
+        return source, None
+
+    source.seek(0, os.SEEK_END)
+    size = source.tell()
+    source.seek(0)
+    if size <= IMAGE_POOL_INLINE_BYTES:
+        return source.read(), None
+
+    fd, path = tempfile.mkstemp(prefix='upload-')
+    with os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(source, f)
+    return path, path
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class ImagePipeline:
+    """Пул процессов для normalize_upload с ограниченной очередью"""
+
+    def __init__(self, workers=IMAGE_WORKERS, queue_size=IMAGE_QUEUE_SIZE, timeout=IMAGE_JOB_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(queue_size, 1))
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        # Пул создаётся лениво, чтобы импорт модуля не запускал процессы
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                print(f"✅ Image pipeline started: {self.workers} workers", flush=True)
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def process(self, source):
+        """Нормализовать фото, дождавшись результата из пула
+
+        source - bytes, путь или файловый объект (см. normalize_upload).
+        Бросает PipelineBusy если очередь заполнена и PipelineTimeout
+        если задача не завершилась за IMAGE_JOB_TIMEOUT секунд.
+        """
+        if self.workers <= 0:
+            return normalize_upload(source)
+
+        if not self._slots.acquire(blocking=False):
+            raise PipelineBusy(f'Image queue is full ({self.workers} workers busy)')
+
+        tmp_path = None
+        try:
+            job_source, tmp_path = _pool_source(source)
+            future = self._get_executor().submit(normalize_upload, job_source)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._reset_executor()
+            if tmp_path:
+                _remove_file(tmp_path)
+            raise
+        except Exception:
+            self._slots.release()
+            if tmp_path:
+                _remove_file(tmp_path)
+            raise
+
+        # Слот (и временный файл) освобождаются когда задача реально
+        # завершилась, а не когда вызывающий перестал ждать
+        def on_done(_):
+            self._slots.release()
+            if tmp_path:
+                _remove_file(tmp_path)
+
+        future.add_done_callback(on_done)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise PipelineTimeout(f'Image processing took longer than {self.timeout}s')
+        except BrokenProcessPool:
+            # Воркер упал (например, OOM) - следующий вызов создаст новый пул
+            self._reset_executor()
+            raise
+
+    def shutdown(self):
+        self._reset_executor()
+
+
+image_pipeline = ImagePipeline()
+
+
+if __name__ == '__main__':
+    # Замер на локальных файлах: python image_pipeline.py photo1.jpg photo2.heic
+    print("=" * 60)
+    print("📏 IMAGE PIPELINE MEASUREMENT")
+    print("=" * 60)
+
+    for path in sys.argv[1:]:
+        try:
+            stats = normalize_upload(path, measure=True)['stats']
+        except Exception as e:
+            print(f"❌ {path}: {e}")
+            continue
+        if stats['passthrough']:
+            print(
+                f"{path}: {stats['source_size'][0]}x{stats['source_size'][1]} "
+                f"passthrough ({stats['output_kb']} KB), total {stats['total_ms']} ms"
+            )
+            continue
+        print(
+            f"{path}: {stats['source_size'][0]}x{stats['source_size'][1]} "
+            f"-> decoded {stats['decoded_size'][0]}x{stats['decoded_size'][1]} "
+            f"({stats['decoded_mb']} MB), decode {stats['decode_ms']} ms, "
+            f"encode q{stats['encode_quality']} {stats['encode_subsampling']} "
+            f"{stats['output_kb']} KB in {stats['encode_ms']} ms, "
+            f"total {stats['total_ms']} ms, peak RSS {stats['peak_rss_mb']} MB"
+        )
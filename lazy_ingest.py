@@ -0,0 +1,115 @@
+"""
+Отложенная загрузка оригиналов из Telegram (LAZY_INGEST=1 у бота)
+
+В ленивом режиме бот сохраняет в SessionPhoto только telegram_file_id,
+размер и (для сжатых фото) размеры в пикселях. Оригинал скачивается,
+нормализуется (image_pipeline) и кладётся в blob store при первом
+обращении фотобудки - дальше фото отдаётся как обычно. Брошенные
+сессии не стоят ни трафика, ни CPU, ни места на диске.
+
+Повторное скачивание одного фото параллельными запросами исключено
+только внутри процесса (_photo_locks); разные worker-процессы могут
+скачать его дважды - результат тот же blob.
+
+Скачивание идёт токеном backend'а (TELEGRAM_BOT_TOKEN в telegram_delivery),
+он должен совпадать с токеном бота - file_id привязан к боту.
+"""
+import os
+import threading
+from datetime import datetime
+
+from models import db, SessionPhoto
+from photo_retention import release_blobs
+from photo_storage import blob_store
+from image_pipeline import image_pipeline
+from telegram_delivery import download_file
+from write_queue import run_write
+
+_lock = threading.Lock()
+_photo_locks = {}
+
+
+class IngestError(Exception):
+    """Не удалось получить оригинал из Telegram"""
+
+
+def is_pending(photo):
+    """Фото пока известно только по file_id (байтов ещё нет)"""
+    if photo.photo_path or photo.purged_at or not photo.telegram_file_id:
+        return False
+    # photo_data отложенная колонка - проверяем запросом, не загружая base64
+    return db.session.query(SessionPhoto.id).filter(
+        SessionPhoto.id == photo.id, SessionPhoto.photo_data.is_(None)
+    ).first() is not None
+
+
+def ensure_ingested(photo):
+    """Скачать и сохранить оригинал если фото ещё не загружено
+
+    Параллельные запросы одного фото ждут друг друга, поэтому оригинал
+    скачивается один раз (в пределах процесса; между процессами дубликат
+    отсекает дедупликация blob store и UPDATE ... WHERE photo_path IS NULL).
+    Бросает IngestError если Telegram или обработка фото не сработали.
+    """
+    if not is_pending(photo):
+        return
+
+    with _lock:
+        photo_lock = _photo_locks.setdefault(photo.id, threading.Lock())
+
+    try:
+        with photo_lock:
+            # Пока ждали, фото мог загрузить другой поток
+            db.session.refresh(photo)
+            if is_pending(photo):
+                _ingest(photo)
+    finally:
+        with _lock:
+            _photo_locks.pop(photo.id, None)
+
+
+def _ingest(photo):
+    try:
+        with download_file(photo.telegram_file_id) as upload:
+            result = image_pipeline.process(upload)
+    except Exception as e:
+        print(f"❌ Lazy ingest failed for photo {photo.id}: {e}", flush=True)
+        raise IngestError(str(e))
+
+    photo_id = photo.id
+    photo_path = blob_store.put(result['data'])
+    metadata = result['metadata']
+    taken_at = metadata.get('taken_at')
+
+    def write():
+        # Пока шло скачивание, фото могла очистить retention - не оживляем
+        return db.session.execute(
+            db.update(SessionPhoto)
+            .where(
+                SessionPhoto.id == photo_id,
+                SessionPhoto.photo_path.is_(None),
+                SessionPhoto.purged_at.is_(None),
+            )
+            .values(
+                photo_path=photo_path,
+                width=result['width'],
+                height=result['height'],
+                byte_size=os.path.getsize(blob_store.path(photo_path)),
+                orientation=metadata.get('orientation'),
+                original_width=metadata.get('original_width'),
+                original_height=metadata.get('original_height'),
+                taken_at=datetime.fromisoformat(taken_at) if taken_at else None,
+                color_space=metadata.get('color_space'),
+                encode_quality=metadata.get('encode_quality'),
+            )
+        ).rowcount
+
+    updated = run_write(write)
+    db.session.refresh(photo)
+
+    if updated:
+        print(f"✅ Photo {photo_id} ingested from Telegram ({len(result['data'])} bytes)", flush=True)
+    else:
+        # Фото уже загружено другим процессом или очищено: наш blob
+        # нужен только если на него ссылается другая строка
+        release_blobs([photo_path])
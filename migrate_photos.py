@@ -0,0 +1,203 @@
+"""
+Перенос старых base64 фото из SQLite в blob store
+
+Строки session_photos с photo_data (data URI) обрабатываются небольшими
+пачками: байты пишутся в photo_storage, в строке остаётся photo_path,
+photo_data обнуляется. Прогресс сохраняется в checkpoint файл, поэтому
+миграцию можно прервать (Ctrl+C) и продолжить с того же места.
+
+Каждая пачка - короткая транзакция, а запись файлов идёт вне транзакции,
+так что миграция может работать параллельно с живым трафиком.
+В конце освобождённые страницы возвращаются incremental vacuum'ом.
+
+Запуск:
+    python migrate_photos.py                 # миграция + incremental vacuum
+    python migrate_photos.py --batch-size 20 --sleep 0.5
+    python migrate_photos.py --reset         # начать заново (сбросить checkpoint)
+    python migrate_photos.py --enable-incremental-vacuum
+        # один раз перевести БД в auto_vacuum=INCREMENTAL (полный VACUUM,
+        # блокирует БД - запускать при остановленном сервере)
+"""
+import argparse
+import json
+import os
+import time
+
+from models import db, SessionPhoto
+from photo_retention import release_blobs
+from photo_storage import PHOTO_STORAGE_DIR, blob_store, decode_image_data_uri
+
+CHECKPOINT_PATH = os.getenv(
+    'MIGRATE_CHECKPOINT_PATH', os.path.join(os.path.dirname(PHOTO_STORAGE_DIR), 'migrate_photos.checkpoint.json')
+)
+
+# Сколько страниц освобождать за один шаг incremental vacuum
+VACUUM_PAGES_PER_STEP = 1000
+
+
+def load_checkpoint():
+    if os.path.exists(CHECKPOINT_PATH):
+        with open(CHECKPOINT_PATH) as f:
+            return json.load(f)
+    return {'last_id': 0, 'migrated': 0, 'skipped': 0}
+
+
+def save_checkpoint(checkpoint):
+    os.makedirs(os.path.dirname(CHECKPOINT_PATH), exist_ok=True)
+    tmp_path = CHECKPOINT_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, CHECKPOINT_PATH)
+
+
+def migrate_batch(last_id, batch_size):
+    """Перенести одну пачку строк, вернуть (last_id, migrated, skipped) или None"""
+    rows = (
+        db.session.query(SessionPhoto.id, SessionPhoto.photo_data)
+        .filter(SessionPhoto.id > last_id)
+        .filter(SessionPhoto.photo_data.isnot(None))
+        .filter(SessionPhoto.photo_path.is_(None))
+        .order_by(SessionPhoto.id)
+        .limit(batch_size)
+        .all()
+    )
+    # Завершаем читающую транзакцию до записи файлов
+    db.session.commit()
+
+    if not rows:
+        return None
+
+    updates = []
+    skipped = 0
+    for photo_id, photo_data in rows:
+        data, _ = decode_image_data_uri(photo_data)
+        if data is None:
+            # Не изображение в base64 (например, тестовые строки) - оставляем как есть
+            skipped += 1
+            continue
+        updates.append({'photo_id': photo_id, 'photo_path': blob_store.put(data)})
+
+    migrated = 0
+    if updates:
+        # Короткая транзакция: только UPDATE по id. Строку могла очистить
+        # retention, пока писали файл - такую не трогаем
+        statement = db.text(
+            'UPDATE session_photos SET photo_path = :photo_path, photo_data = NULL '
+            'WHERE id = :photo_id AND photo_path IS NULL '
+            'AND purged_at IS NULL AND photo_data IS NOT NULL'
+        )
+        stale = []
+        for update in updates:
+            if db.session.execute(statement, update).rowcount:
+                migrated += 1
+            else:
+                stale.append(update['photo_path'])
+        db.session.commit()
+        release_blobs(stale)
+
+    return rows[-1][0], migrated, skipped
+
+
+def is_sqlite():
+    return db.engine.dialect.name == 'sqlite'
+
+
+def incremental_vacuum(sleep):
+    """Вернуть свободные страницы файлу БД небольшими шагами"""
+    if not is_sqlite():
+        return
+
+    mode = db.session.execute(db.text('PRAGMA auto_vacuum')).scalar()
+    free_pages = db.session.execute(db.text('PRAGMA freelist_count')).scalar()
+    db.session.commit()
+
+    if mode != 2:
+        print(f"⚠️  auto_vacuum={mode}, incremental vacuum недоступен ({free_pages} свободных страниц)")
+        print("   Один раз выполните: python migrate_photos.py --enable-incremental-vacuum")
+        return
+
+    page_size = db.session.execute(db.text('PRAGMA page_size')).scalar()
+    initial = free_pages
+
+    # Через sqlite3 напрямую: execute() выполняет один шаг pragma и
+    # освобождает одну страницу, executescript() - все N за шаг
+    connection = db.engine.raw_connection()
+    try:
+        sqlite_connection = connection.driver_connection
+        while free_pages > 0:
+            sqlite_connection.executescript(f'PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP});')
+            remaining = sqlite_connection.execute('PRAGMA freelist_count').fetchone()[0]
+            if remaining >= free_pages:
+                break
+            free_pages = remaining
+            if free_pages:
+                time.sleep(sleep)
+    finally:
+        connection.close()
+
+    reclaimed = initial - free_pages
+    print(f"✅ Incremental vacuum: reclaimed {reclaimed * page_size / 1024 / 1024:.1f} MB ({reclaimed} pages)")
+
+
+def enable_incremental_vacuum():
+    """Перевести БД в auto_vacuum=INCREMENTAL (требует полного VACUUM)"""
+    if not is_sqlite():
+        print("⚠️  Только для SQLite")
+        return
+
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(db.text('PRAGMA auto_vacuum = INCREMENTAL'))
+        conn.execute(db.text('VACUUM'))
+        mode = conn.execute(db.text('PRAGMA auto_vacuum')).scalar()
+
+    print(f"✅ auto_vacuum = {mode}")
+
+
+def run(batch_size, sleep, vacuum=True):
+    checkpoint = load_checkpoint()
+
+    print("=" * 60)
+    print("📦 MIGRATION: base64 photos -> blob store")
+    print(f"   Resuming after id {checkpoint['last_id']} ({checkpoint['migrated']} migrated)")
+    print("=" * 60)
+
+    while True:
+        result = migrate_batch(checkpoint['last_id'], batch_size)
+        if result is None:
+            break
+
+        last_id, migrated, skipped = result
+        checkpoint['last_id'] = last_id
+        checkpoint['migrated'] += migrated
+        checkpoint['skipped'] += skipped
+        save_checkpoint(checkpoint)
+
+        print(f"✅ Batch up to id {last_id}: {migrated} migrated, {skipped} skipped", flush=True)
+
+        # Даём живым запросам захватить блокировку
+        time.sleep(sleep)
+
+    print(f"✅ Migration done: {checkpoint['migrated']} migrated, {checkpoint['skipped']} skipped")
+
+    if vacuum:
+        incremental_vacuum(sleep)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Перенос base64 фото из SQLite в blob store')
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--sleep', type=float, default=0.1, help='пауза между пачками, сек')
+    parser.add_argument('--reset', action='store_true', help='сбросить checkpoint')
+    parser.add_argument('--no-vacuum', action='store_true')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true')
+    args = parser.parse_args()
+
+    from app import app
+
+    with app.app_context():
+        if args.enable_incremental_vacuum:
+            enable_incremental_vacuum()
+        else:
+            if args.reset and os.path.exists(CHECKPOINT_PATH):
+                os.remove(CHECKPOINT_PATH)
+            run(args.batch_size, args.sleep, vacuum=not args.no_vacuum)
@@ -0,0 +1,217 @@
+"""
+Версионные миграции схемы БД
+
+Схема больше не создаётся db.create_all() при импорте app.py: она
+меняется только миграциями из MIGRATIONS, применённые версии
+записываются в таблицу schema_version. app.py при старте проверяет
+версию (check_schema) и отказывается работать с неполной схемой.
+
+Запуск (перед стартом сервера после каждого обновления):
+    python migrations.py            # применить недостающие миграции
+    python migrations.py --status   # текущая версия и список миграций
+    python migrations.py --repair-counters
+        # пересчитать sessions.uploaded_count/result_count по session_photos
+        # (например после ручного удаления фото в db_viewer)
+
+Новая БД создаётся сразу по моделям и помечается последней версией.
+Старая БД без schema_version проходит все миграции начиная с baseline.
+
+Правила для новых миграций:
+- функция migration(engine) в конец MIGRATIONS с номером на 1 больше;
+- выпущенные миграции не меняются;
+- миграция идемпотентна (IF NOT EXISTS, проверка колонок) - baseline
+  на старой БД уже добавляет колонки текущих моделей;
+- индексы создаются онлайн (_create_index): в PostgreSQL через
+  CREATE INDEX CONCURRENTLY без блокировки записи, в SQLite (WAL)
+  чтения во время построения индекса не блокируются.
+"""
+import argparse
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from db_engine import configure_engine, database_url, engine_options
+from models import db, repair_photo_counters
+
+schema_version = sa.Table(
+    'schema_version', sa.MetaData(),
+    sa.Column('version', sa.Integer, primary_key=True),
+    sa.Column('name', sa.String(200), nullable=False),
+    sa.Column('applied_at', sa.DateTime, nullable=False),
+)
+
+
+class SchemaOutdated(RuntimeError):
+    """БД не на последней версии схемы"""
+
+
+# ============================================
+# ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
+# ============================================
+
+def _add_missing_columns(engine):
+    """Добавить в существующие таблицы колонки моделей, которых там нет
+
+    Такие колонки либо nullable, либо со server_default, поэтому хватает
+    ALTER TABLE ADD COLUMN (тип, DEFAULT и NOT NULL берутся из модели).
+    """
+    inspector = sa.inspect(engine)
+    added = []
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                definition = sa.schema.CreateColumn(column).compile(dialect=engine.dialect)
+                conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {definition}')
+                added.append(f'{table.name}.{column.name}')
+
+    for column in added:
+        print(f"✅ Column added: {column}", flush=True)
+
+
+def _create_index(engine, name, table, columns):
+    """CREATE INDEX IF NOT EXISTS без долгой блокировки записи"""
+    postgresql = engine.dialect.name == 'postgresql'
+
+    # CONCURRENTLY не работает внутри транзакции
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if postgresql:
+            # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный
+            # индекс, который IF NOT EXISTS молча пропустил бы
+            invalid = conn.execute(sa.text(
+                'SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+                'WHERE c.relname = :name AND NOT i.indisvalid'
+            ), {'name': name}).first()
+            if invalid:
+                conn.exec_driver_sql(f'DROP INDEX CONCURRENTLY {name}')
+
+        concurrently = 'CONCURRENTLY ' if postgresql else ''
+        conn.exec_driver_sql(
+            f'CREATE INDEX {concurrently}IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'
+        )
+    print(f"✅ Index ready: {name}", flush=True)
+
+
+# ============================================
+# МИГРАЦИИ
+# ============================================
+
+def _baseline(engine):
+    """Схема до появления миграций: create_all + недостающие колонки"""
+    db.metadata.create_all(engine)
+    _add_missing_columns(engine)
+
+
+def _hot_path_indexes(engine):
+    """Индексы под частые запросы (очистка, фото сессии, платежи)"""
+    _create_index(engine, 'ix_sessions_expires_at', 'sessions', ['expires_at'])
+    _create_index(engine, 'ix_session_photos_session_type_order', 'session_photos',
+                  ['session_id', 'photo_type', 'order_index'])
+    _create_index(engine, 'ix_payments_status_created_at', 'payments', ['status', 'created_at'])
+    _create_index(engine, 'ix_payments_create_time', 'payments', ['create_time'])
+
+
+def _session_photo_counters(engine):
+    """sessions.uploaded_count/result_count и их начальные значения"""
+    _add_missing_columns(engine)
+    with engine.begin() as conn:
+        repaired = repair_photo_counters(conn)
+    print(f"✅ Photo counters filled for {repaired} sessions", flush=True)
+
+
+MIGRATIONS = [
+    (1, 'baseline schema', _baseline),
+    (2, 'hot path indexes', _hot_path_indexes),
+    (3, 'session photo counters', _session_photo_counters),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# ============================================
+# ПРИМЕНЕНИЕ И ПРОВЕРКА
+# ============================================
+
+def current_version(engine):
+    """Последняя применённая версия или None если миграций ещё не было"""
+    if not sa.inspect(engine).has_table(schema_version.name):
+        return None
+    with engine.connect() as conn:
+        return conn.execute(sa.select(sa.func.max(schema_version.c.version))).scalar()
+
+
+def _stamp(engine, version, name):
+    with engine.begin() as conn:
+        conn.execute(schema_version.insert().values(version=version, name=name, applied_at=datetime.utcnow()))
+
+
+def migrate(engine):
+    """Применить недостающие миграции, вернуть итоговую версию"""
+    schema_version.create(engine, checkfirst=True)
+    current = current_version(engine)
+
+    if current is None:
+        application_tables = [table.name for table in db.metadata.sorted_tables]
+        if not any(sa.inspect(engine).has_table(name) for name in application_tables):
+            # Новая БД: модели уже описывают последнюю версию
+            db.metadata.create_all(engine)
+            for version, name, _ in MIGRATIONS:
+                _stamp(engine, version, name)
+            print(f"✅ Database created at schema version {LATEST_VERSION}", flush=True)
+            return LATEST_VERSION
+        current = 0
+
+    for version, name, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"🔧 Migration {version}: {name}", flush=True)
+        migration(engine)
+        _stamp(engine, version, name)
+        current = version
+
+    print(f"✅ Database at schema version {current}", flush=True)
+    return current
+
+
+def check_schema(engine):
+    """Версия схемы; SchemaOutdated если миграции не применены"""
+    current = current_version(engine)
+    if current is None or current < LATEST_VERSION:
+        raise SchemaOutdated(
+            f'Database schema version {current or 0}, required {LATEST_VERSION}: '
+            f'run "python migrations.py" first'
+        )
+    if current > LATEST_VERSION:
+        print(f"⚠️  Database schema version {current} is newer than this code ({LATEST_VERSION})", flush=True)
+    return current
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Миграции схемы БД')
+    parser.add_argument('--status', action='store_true', help='показать версию и не менять БД')
+    parser.add_argument('--repair-counters', action='store_true', help='пересчитать счётчики фото сессий')
+    args = parser.parse_args()
+
+    url = database_url()
+    engine = sa.create_engine(url, **engine_options(url))
+    configure_engine(engine)
+
+    if args.status:
+        current = current_version(engine)
+        print(f"Schema version: {current or 0} (latest {LATEST_VERSION})")
+        for version, name, _ in MIGRATIONS:
+            mark = '✅' if current and version <= current else '⏳'
+            print(f"  {mark} {version}: {name}")
+    elif args.repair_counters:
+        check_schema(engine)
+        with engine.begin() as conn:
+            repaired = repair_photo_counters(conn)
+        print(f"✅ Photo counters repaired for {repaired} sessions")
+    else:
+        migrate(engine)
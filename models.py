@@ -1,12 +1,19 @@
 from flask_sqlalchemy import SQLAlchemy
+from collections import defaultdict
 from datetime import datetime
 import json
 
+from photo_storage import blob_store, decode_data_uri, detect_mime, encode_data_uri
+
 db = SQLAlchemy()
 
 class Payment(db.Model):
     """Модель для хранения информации о платежах"""
     __tablename__ = 'payments'
+    __table_args__ = (
+        db.Index('ix_payments_status_created_at', 'status', 'created_at'),  # /api/payments, /api/stats
+        db.Index('ix_payments_create_time', 'create_time'),  # Payme GetStatement
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.String(100), unique=True, nullable=False, index=True)
@@ -89,6 +96,9 @@ class Session(db.Model):
     - download: пользователь скачивает готовые фото
     """
     __tablename__ = 'sessions'
+    __table_args__ = (
+        db.Index('ix_sessions_expires_at', 'expires_at'),  # очистка и список сессий
+    )
     
     id = db.Column(db.String(36), primary_key=True)  # UUID
     kiosk_id = db.Column(db.Integer)  # ID фотобудки (для multi-kiosk setup)
@@ -104,6 +114,11 @@ class Session(db.Model):
     
     data = db.Column(db.Text)  # JSON данные (дополнительная информация)
     
+    # Счётчики фото по типу - обновляются при каждой вставке/удалении
+    # SessionPhoto в той же транзакции (_count_session_photos)
+    uploaded_count = db.Column(db.Integer, nullable=False, default=0, server_default=db.text('0'))
+    result_count = db.Column(db.Integer, nullable=False, default=0, server_default=db.text('0'))
+    
     # Relationships
     photos = db.relationship('SessionPhoto', backref='session', lazy='dynamic', cascade='all, delete-orphan')
     
@@ -122,9 +137,15 @@ class Session(db.Model):
             'telegram_user_id': self.telegram_user_id,
             'telegram_username': self.telegram_username,
             'data': json.loads(self.data) if self.data else None,
-            'photos_count': self.photos.count()
+            'photos_count': (self.uploaded_count or 0) + (self.result_count or 0),
+            'uploaded_count': self.uploaded_count or 0,
+            'result_count': self.result_count or 0
         }
     
+    def photo_count(self, photo_type):
+        """Число фото типа 'uploaded' или 'result' (без запроса к session_photos)"""
+        return getattr(self, PHOTO_COUNTERS[photo_type]) or 0
+    
     @property
     def is_expired(self):
         """Проверка истекла ли сессия"""
@@ -143,13 +164,19 @@ class SessionPhoto(db.Model):
     так и готовые обработанные фото (type='result')
     """
     __tablename__ = 'session_photos'
+    __table_args__ = (
+        # Подсчёт и список фото сессии по типу в порядке order_index
+        db.Index('ix_session_photos_session_type_order', 'session_id', 'photo_type', 'order_index'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(36), db.ForeignKey('sessions.id'), nullable=False)
     
     photo_type = db.Column(db.String(20), nullable=False)  # 'uploaded' или 'result'
-    photo_path = db.Column(db.String(500))  # Путь к файлу на диске
-    photo_data = db.Column(db.Text)  # Base64 данные (опционально)
+    photo_path = db.Column(db.String(500))  # Ссылка на blob в photo_storage (ab/cd/<sha256>)
+    # Base64 данные (устаревшее, новые фото хранятся в blob store).
+    # deferred: колонка не читается из БД пока к ней не обратились
+    photo_data = db.deferred(db.Column(db.Text))
     
     telegram_file_id = db.Column(db.String(200))  # File ID из Telegram
     telegram_file_size = db.Column(db.Integer)  # Размер файла
@@ -161,19 +188,142 @@ class SessionPhoto(db.Model):
     height = db.Column(db.Integer)
     order_index = db.Column(db.Integer, default=0)  # Порядок фото в сессии
     
+    # Метаданные оригинала (считываются один раз при загрузке,
+    # сохранённые пиксели уже повёрнуты по EXIF)
+    orientation = db.Column(db.Integer)  # EXIF Orientation оригинала (1-8)
+    original_width = db.Column(db.Integer)
+    original_height = db.Column(db.Integer)
+    taken_at = db.Column(db.DateTime)  # Время съёмки из EXIF
+    color_space = db.Column(db.String(50))  # sRGB, Display P3, ...
+    byte_size = db.Column(db.Integer)  # Размер сохранённого файла
+    encode_quality = db.Column(db.Integer)  # Качество JPEG, выбранное при загрузке
+    
+    # Когда байты фото удалены политикой хранения (метаданные остаются)
+    purged_at = db.Column(db.DateTime)
+    
     def __repr__(self):
         return f'<SessionPhoto {self.id} - {self.photo_type}>'
     
-    def to_dict(self):
-        return {
+    def read_bytes(self):
+        """Байты фото из blob store (или из старого base64 в photo_data)"""
+        if self.photo_path and blob_store.exists(self.photo_path):
+            return blob_store.get(self.photo_path)
+        if self.photo_data:
+            data, _ = decode_data_uri(self.photo_data)
+            return data
+        return None
+
+    @property
+    def data_uri(self):
+        """Фото как data URI (для обратной совместимости JSON API)"""
+        if self.photo_data:
+            return self.photo_data
+        if self.photo_path and blob_store.exists(self.photo_path):
+            data = blob_store.get(self.photo_path)
+            return encode_data_uri(data, detect_mime(data))
+        return None
+
+    def to_dict(self, fields=None, include_data=True):
+        """Преобразование в словарь для JSON ответа
+        
+        fields - список полей которые нужно вернуть (None = все),
+        include_data=False - не загружать и не отдавать photo_data
+        """
+        result = {
             'id': self.id,
             'session_id': self.session_id,
             'photo_type': self.photo_type,
             'photo_path': self.photo_path,
-            'photo_data': self.photo_data if self.photo_data else None,
+            'file_url': f'/api/session/{self.session_id}/photos/{self.id}/file',
             'telegram_file_id': self.telegram_file_id,
             'uploaded_at': self.uploaded_at.isoformat() if self.uploaded_at else None,
             'width': self.width,
             'height': self.height,
-            'order_index': self.order_index
-        }
\ No newline at end of file
+            'order_index': self.order_index,
+            'orientation': self.orientation,
+            'original_width': self.original_width,
+            'original_height': self.original_height,
+            'taken_at': self.taken_at.isoformat() if self.taken_at else None,
+            'color_space': self.color_space,
+            'byte_size': self.byte_size,
+            'encode_quality': self.encode_quality,
+            'purged_at': self.purged_at.isoformat() if self.purged_at else None
+        }
+        
+        # Самое тяжёлое поле - читаем байты только если их действительно просят
+        if include_data:
+            result['photo_data'] = self.data_uri
+        
+        if fields:
+            result = {key: result[key] for key in fields if key in result}
+        
+        return result
+
+
+# ============================================
+# СЧЁТЧИКИ ФОТО СЕССИИ
+# ============================================
+
+# photo_type -> колонка счётчика в sessions
+PHOTO_COUNTERS = {'uploaded': 'uploaded_count', 'result': 'result_count'}
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def _count_session_photos(session, flush_context, instances):
+    """Обновить счётчики сессий для вставляемых и удаляемых фото
+
+    Атомарный UPDATE ... SET uploaded_count = uploaded_count + N в той же
+    транзакции (и SAVEPOINT очереди записи), что и INSERT/DELETE фото.
+    Массовые query.delete() мимо ORM счётчики не обновляют.
+    """
+    deltas = defaultdict(int)
+    for photos, sign in ((session.new, 1), (session.deleted, -1)):
+        for photo in photos:
+            if isinstance(photo, SessionPhoto) and photo.photo_type in PHOTO_COUNTERS:
+                session_id = photo.session_id or (photo.session.id if photo.session else None)
+                deltas[(session_id, PHOTO_COUNTERS[photo.photo_type])] += sign
+
+    sessions = Session.__table__
+    for (session_id, column), delta in deltas.items():
+        if session_id is None or not delta:
+            continue
+
+        parent = session.identity_map.get(db.inspect(Session).identity_key_from_primary_key((session_id,)))
+        if parent is not None and parent in session.deleted:
+            continue  # сессия удаляется вместе с фото
+        if parent is not None and parent in session.new:
+            setattr(parent, column, (getattr(parent, column) or 0) + delta)
+            continue
+
+        session.connection().execute(
+            db.update(sessions).where(sessions.c.id == session_id)
+            .values({column: sessions.c[column] + delta})
+        )
+        if parent is not None:
+            session.expire(parent, [column])
+
+
+def repair_photo_counters(connection):
+    """Пересчитать uploaded_count/result_count по session_photos
+
+    connection - db.session или Connection. Возвращает число сессий,
+    у которых счётчики расходились с фактическим числом фото.
+    """
+    sessions = Session.__table__
+    photos = SessionPhoto.__table__
+
+    def actual(photo_type):
+        return (
+            db.select(db.func.count(photos.c.id))
+            .where(photos.c.session_id == sessions.c.id, photos.c.photo_type == photo_type)
+            .scalar_subquery()
+        )
+
+    return connection.execute(
+        db.update(sessions)
+        .where(db.or_(
+            sessions.c.uploaded_count != actual('uploaded'),
+            sessions.c.result_count != actual('result'),
+        ))
+        .values(uploaded_count=actual('uploaded'), result_count=actual('result'))
+    ).rowcount
@@ -0,0 +1,230 @@
+"""
+Политики хранения фото: удаление байтов с сохранением метаданных
+
+- uploaded / result фото теряют байты через N часов после загрузки
+  или через M часов после выдачи (сессия completed)
+- общий бюджет хранилища: при превышении удаляются самые старые фото
+  (только у сессий, которые уже истекли или завершены)
+
+Строки SessionPhoto остаются (purged_at != NULL), удаляются только
+blob'ы в photo_storage и старый base64 в photo_data. Заодно убираются
+blob'ы без ссылок, которые release_blobs() оставил из-за окна ожидания.
+
+Запуск: POST /api/photos/retention или python photo_retention.py
+"""
+import os
+import time
+from datetime import datetime, timedelta
+
+from models import db, Session, SessionPhoto
+from photo_storage import BLOB_RELEASE_GRACE_SECONDS, blob_store
+
+# ============================================
+# КОНФИГУРАЦИЯ
+# ============================================
+
+# max_age_hours=0 или after_delivery_hours=-1 отключают соответствующее правило
+RETENTION_POLICIES = {
+    'uploaded': {
+        'max_age_hours': float(os.getenv('RETENTION_UPLOADED_HOURS', '24')),
+        'after_delivery_hours': float(os.getenv('RETENTION_UPLOADED_AFTER_DELIVERY_HOURS', '1')),
+    },
+    'result': {
+        'max_age_hours': float(os.getenv('RETENTION_RESULT_HOURS', '72')),
+        'after_delivery_hours': float(os.getenv('RETENTION_RESULT_AFTER_DELIVERY_HOURS', '24')),
+    },
+}
+
+# 0 - без общего лимита
+STORAGE_BUDGET_BYTES = int(float(os.getenv('STORAGE_BUDGET_MB', '0')) * 1024 * 1024)
+
+
+def release_blobs(refs):
+    """Удалить blob'ы на которые больше не ссылается ни одно фото
+
+    Недавно записанные (или повторно полученные через put()) blob'ы
+    остаются - на них может сослаться ещё не закоммиченная строка,
+    их позже уберёт sweep_orphan_blobs(). Возвращает освобождённые байты
+    """
+    freed = 0
+    for ref in set(refs):
+        if not ref or SessionPhoto.query.filter_by(photo_path=ref).first():
+            continue
+        freed += blob_store.release(ref)
+    return freed
+
+
+def sweep_orphan_blobs(dry_run=False):
+    """Удалить blob'ы без ссылок из БД, старше окна BLOB_RELEASE_GRACE
+
+    Возвращает (количество, байты)
+    """
+    referenced = {
+        ref for (ref,) in db.session.query(SessionPhoto.photo_path)
+        .filter(SessionPhoto.photo_path.isnot(None)).distinct()
+    }
+    count = freed = 0
+    for ref in blob_store.refs():
+        if ref in referenced:
+            continue
+        if dry_run:
+            path = blob_store.path(ref)
+            if os.path.getmtime(path) < time.time() - BLOB_RELEASE_GRACE_SECONDS:
+                count += 1
+                freed += os.path.getsize(path)
+            continue
+        size = blob_store.release(ref)
+        if size:
+            count += 1
+            freed += size
+    return count, freed
+
+
+def _has_data():
+    return db.or_(SessionPhoto.photo_path.isnot(None), SessionPhoto.photo_data.isnot(None))
+
+
+def _inline_size(photo_ids):
+    """Размер старого base64 в photo_data (без загрузки самих строк)"""
+    if not photo_ids:
+        return 0
+    return db.session.query(
+        db.func.coalesce(db.func.sum(db.func.length(SessionPhoto.photo_data)), 0)
+    ).filter(SessionPhoto.id.in_(photo_ids)).scalar()
+
+
+def storage_usage():
+    """Сколько байтов занимают фото (blob'ы считаются один раз)"""
+    refs = {
+        ref for (ref,) in db.session.query(SessionPhoto.photo_path)
+        .filter(SessionPhoto.photo_path.isnot(None)).distinct()
+    }
+    blob_bytes = sum(
+        os.path.getsize(blob_store.path(ref)) for ref in refs if blob_store.exists(ref)
+    )
+    inline_bytes = db.session.query(
+        db.func.coalesce(db.func.sum(db.func.length(SessionPhoto.photo_data)), 0)
+    ).scalar()
+    return blob_bytes + inline_bytes
+
+
+def _expired_candidates(photo_type, policy, now):
+    """Фото которые пора очистить по возрасту или после выдачи"""
+    conditions = []
+
+    if policy['max_age_hours'] > 0:
+        conditions.append(SessionPhoto.uploaded_at < now - timedelta(hours=policy['max_age_hours']))
+
+    if policy['after_delivery_hours'] >= 0:
+        conditions.append(db.and_(
+            Session.completed_at.isnot(None),
+            Session.completed_at < now - timedelta(hours=policy['after_delivery_hours'])
+        ))
+
+    if not conditions:
+        return []
+
+    return (
+        SessionPhoto.query.join(Session)
+        .filter(SessionPhoto.photo_type == photo_type)
+        .filter(SessionPhoto.purged_at.is_(None))
+        .filter(_has_data())
+        .filter(db.or_(*conditions))
+        .all()
+    )
+
+
+def _budget_candidates(now):
+    """Самые старые фото неактивных сессий - для вытеснения по бюджету"""
+    return (
+        db.session.query(SessionPhoto, db.func.coalesce(db.func.length(SessionPhoto.photo_data), 0))
+        .join(Session)
+        .filter(SessionPhoto.purged_at.is_(None))
+        .filter(_has_data())
+        .filter(db.or_(Session.expires_at < now, Session.completed_at.isnot(None)))
+        .order_by(SessionPhoto.uploaded_at)
+        .yield_per(100)
+    )
+
+
+def _purge(photos, now):
+    """Удалить байты фото, оставив строки. Возвращает освобождённые байты"""
+    if not photos:
+        return 0
+
+    inline_bytes = _inline_size([photo.id for photo in photos])
+    refs = [photo.photo_path for photo in photos]
+
+    for photo in photos:
+        photo.photo_path = None
+        photo.photo_data = None
+        photo.purged_at = now
+
+    db.session.commit()
+
+    return inline_bytes + release_blobs(refs)
+
+
+def apply_retention(now=None, dry_run=False):
+    """Применить политики хранения, вернуть отчёт о том что удалено"""
+    now = now or datetime.utcnow()
+
+    report = {
+        'dry_run': dry_run,
+        'purged': {},
+        'evicted_for_budget': 0,
+        'reclaimed_bytes': 0,
+        'budget_bytes': STORAGE_BUDGET_BYTES,
+    }
+
+    for photo_type, policy in RETENTION_POLICIES.items():
+        photos = _expired_candidates(photo_type, policy, now)
+        report['purged'][photo_type] = len(photos)
+        if not dry_run:
+            report['reclaimed_bytes'] += _purge(photos, now)
+
+    usage = storage_usage()
+
+    if STORAGE_BUDGET_BYTES and usage > STORAGE_BUDGET_BYTES:
+        overflow = usage - STORAGE_BUDGET_BYTES
+        batch = []
+        batch_refs = set()
+        planned = 0
+
+        # Общий blob считаем один раз (он освободится, только если
+        # все ссылающиеся на него фото попадут в очистку)
+        for photo, inline_bytes in _budget_candidates(now):
+            if planned >= overflow:
+                break
+            batch.append(photo)
+            planned += inline_bytes
+            if photo.photo_path and photo.photo_path not in batch_refs and blob_store.exists(photo.photo_path):
+                batch_refs.add(photo.photo_path)
+                planned += os.path.getsize(blob_store.path(photo.photo_path))
+
+        report['evicted_for_budget'] = len(batch)
+        if not dry_run:
+            report['reclaimed_bytes'] += _purge(batch, now)
+
+    # blob'ы, оставленные release_blobs() из-за окна ожидания
+    orphans, orphan_bytes = sweep_orphan_blobs(dry_run=dry_run)
+    report['orphan_blobs'] = orphans
+    if not dry_run:
+        report['reclaimed_bytes'] += orphan_bytes
+
+    report['storage_bytes'] = storage_usage() if not dry_run else usage
+    report['over_budget'] = bool(STORAGE_BUDGET_BYTES) and report['storage_bytes'] > STORAGE_BUDGET_BYTES
+
+    return report
+
+
+if __name__ == '__main__':
+    import json
+    import sys
+
+    from app import app
+
+    with app.app_context():
+        result = apply_retention(dry_run='--dry-run' in sys.argv)
+
+    print(json.dumps(result, indent=2))
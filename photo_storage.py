@@ -0,0 +1,247 @@
+"""
+Хранилище фотографий на диске (content-addressed blob store)
+
+Байты фото хранятся один раз в файле, имя которого - SHA-256 содержимого.
+Файлы раскладываются по подпапкам (ab/cd/abcd...), чтобы в одной папке
+не скапливались тысячи файлов. Одинаковые загрузки дедуплицируются.
+
+В БД (SessionPhoto.photo_path) хранится только ссылка на blob -
+относительный путь вида "ab/cd/<sha256>".
+
+Из-за дедупликации put() может вернуть ссылку на blob, который другой
+запрос как раз освобождает. Поэтому put() обновляет mtime существующего
+blob'а, а release() не удаляет blob'ы моложе BLOB_RELEASE_GRACE_MINUTES:
+новая строка успевает сослаться на blob, а осиротевшие файлы потом
+убирает photo_retention.sweep_orphan_blobs().
+"""
+import base64
+import binascii
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+PHOTO_STORAGE_DIR = os.getenv('PHOTO_STORAGE_DIR', os.path.join(basedir, 'storage', 'photos'))
+
+# Размер куска при потоковой записи загрузок
+CHUNK_SIZE = 64 * 1024
+
+# Blob, к которому обращался put() за последние N минут, не удаляется
+BLOB_RELEASE_GRACE_SECONDS = float(os.getenv('BLOB_RELEASE_GRACE_MINUTES', '10')) * 60
+
+
+def decode_data_uri(value):
+    """Декодировать data URI (или голый base64) в байты
+
+    Возвращает (bytes, mime_type) или (None, None) если строка не base64
+    """
+    if not value:
+        return None, None
+
+    mime_type = None
+    payload = value
+
+    # Убираем prefix если есть (data:image/jpeg;base64,)
+    if value.startswith('data:') and ',' in value:
+        header, payload = value.split(',', 1)
+        mime_type = header[5:].split(';')[0] or None
+
+    try:
+        return base64.b64decode(payload, validate=True), mime_type
+    except (binascii.Error, ValueError):
+        return None, None
+
+
+def detect_mime(data):
+    """Определить MIME тип изображения по первым байтам"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[4:8] == b'ftyp':
+        brand = data[8:12]
+        if brand in (b'avif', b'avis'):
+            return 'image/avif'
+        if brand in (b'heic', b'heix', b'hevc', b'hevx', b'mif1', b'msf1'):
+            return 'image/heic'
+    return 'application/octet-stream'
+
+
+def decode_image_data_uri(value):
+    """Как decode_data_uri, но только если внутри действительно изображение
+
+    Строки, которые случайно оказались валидным base64 (тестовые данные
+    и т.п.), не переносятся в blob store и остаются как есть.
+    """
+    data, mime_type = decode_data_uri(value)
+    if data is None or detect_mime(data) == 'application/octet-stream':
+        return None, None
+    return data, mime_type
+
+
+def encode_data_uri(data, mime_type='image/jpeg'):
+    """Собрать data URI из байтов (для обратной совместимости JSON API)"""
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+class BlobStore:
+    """Content-addressed хранилище байтов на диске"""
+
+    def __init__(self, root):
+        self.root = root
+        # put() и release() одного процесса не пересекаются: между проверкой
+        # "blob уже есть" и возвратом ссылки файл не может быть удалён
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def ref_for(digest):
+        """Ссылка на blob по SHA-256 (hex)"""
+        return f"{digest[:2]}/{digest[2:4]}/{digest}"
+
+    @staticmethod
+    def digest_of(ref):
+        """SHA-256 (hex) из ссылки на blob"""
+        return ref.rsplit('/', 1)[-1]
+
+    def path(self, ref):
+        """Абсолютный путь к файлу blob'а"""
+        return os.path.join(self.root, *ref.split('/'))
+
+    def exists(self, ref):
+        return bool(ref) and os.path.isfile(self.path(ref))
+
+    def put(self, data):
+        """Сохранить байты, вернуть ссылку на blob
+
+        Если такой blob уже есть - повторно не пишем (дедупликация).
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        ref = self.ref_for(digest)
+        target = self.path(ref)
+
+        if self._touch(target):
+            return ref
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        # Пишем во временный файл и атомарно переименовываем,
+        # чтобы читатели никогда не увидели недописанный blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return ref
+
+    def put_stream(self, stream, chunk_size=CHUNK_SIZE):
+        """Сохранить поток байтов кусками, не держа весь файл в памяти
+
+        SHA-256 считается на лету, поэтому файл сначала пишется во
+        временный, а затем переименовывается по хешу. Возвращает ссылку
+        на blob или None если поток пустой.
+        """
+        tmp_dir = os.path.join(self.root, '.tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+            if size == 0:
+                os.remove(tmp_path)
+                return None
+
+            ref = self.ref_for(sha.hexdigest())
+            target = self.path(ref)
+            if self._touch(target):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(tmp_path, target)
+            return ref
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _touch(self, target):
+        """Обновить mtime существующего blob'а (дедупликация). False если его нет"""
+        with self._lock:
+            try:
+                os.utime(target)
+                return True
+            except FileNotFoundError:
+                return False
+
+    def release(self, ref, grace=BLOB_RELEASE_GRACE_SECONDS):
+        """Удалить blob, если к нему не обращались последние grace секунд
+
+        Вызывающий сам проверяет, что в БД на blob нет ссылок.
+        Возвращает освобождённые байты (0 если blob оставлен или его нет).
+        """
+        path = self.path(ref)
+        with self._lock:
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime > time.time() - grace:
+                    return 0
+                os.remove(path)
+            except FileNotFoundError:
+                return 0
+        return stat.st_size
+
+    def refs(self):
+        """Ссылки всех blob'ов на диске (временные файлы пропускаются)"""
+        if not os.path.isdir(self.root):
+            return
+        for top in os.scandir(self.root):
+            if not top.is_dir() or top.name.startswith('.'):
+                continue
+            for sub in os.scandir(top.path):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        yield f"{top.name}/{sub.name}/{entry.name}"
+
+    def mime(self, ref):
+        """MIME тип blob'а по сигнатуре файла"""
+        with open(self.path(ref), 'rb') as f:
+            return detect_mime(f.read(32))
+
+    def get(self, ref):
+        """Прочитать байты blob'а"""
+        with open(self.path(ref), 'rb') as f:
+            return f.read()
+
+    def delete(self, ref):
+        """Удалить blob (вызывающий сам проверяет что на него нет ссылок)"""
+        try:
+            os.remove(self.path(ref))
+            return True
+        except FileNotFoundError:
+            return False
+
+
+blob_store = BlobStore(PHOTO_STORAGE_DIR)
@@ -0,0 +1,197 @@
+"""
+Сборка листа для печати из фото сессии по шаблону (format_1, format_2, ...)
+
+Шаблон описывает размер листа и прямоугольники (слоты) под фото в долях
+листа. Необязательные рамка (frame.png, RGBA поверх фото) и маска
+(mask.png, где видны фото) лежат в PRINT_TEMPLATES_DIR/<template_name>/.
+Там же можно положить template.json чтобы переопределить встроенный шаблон.
+
+Рамки и маски берутся из template_assets: декодируются один раз и
+разделяются между процессами через memory-mapped файлы.
+"""
+import json
+import os
+import time
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from image_pipeline import ROTATED_ORIENTATIONS, exif_orientation
+from template_assets import PRINT_TEMPLATES_DIR, is_valid_template_name, template_asset_registry
+
+PRINT_DPI = int(os.getenv('PRINT_DPI', '300'))
+
+# Размеры листа в дюймах, слоты - [x, y, w, h] в долях листа,
+# photo - какое по счёту фото сессии ставить в слот
+TEMPLATES = {
+    # Одно фото 10x15
+    'format_1': {
+        'size_in': [4, 6],
+        'slots': [
+            {'box': [0.05, 0.04, 0.90, 0.80], 'photo': 0},
+        ],
+    },
+    # Два фото друг под другом
+    'format_2': {
+        'size_in': [4, 6],
+        'slots': [
+            {'box': [0.05, 0.04, 0.90, 0.42], 'photo': 0},
+            {'box': [0.05, 0.48, 0.90, 0.42], 'photo': 1},
+        ],
+    },
+    # Две одинаковые полоски по 3 фото (лист разрезается пополам)
+    'format_3': {
+        'size_in': [4, 6],
+        'slots': [
+            {'box': [0.04, 0.03, 0.42, 0.27], 'photo': 0},
+            {'box': [0.04, 0.32, 0.42, 0.27], 'photo': 1},
+            {'box': [0.04, 0.61, 0.42, 0.27], 'photo': 2},
+            {'box': [0.54, 0.03, 0.42, 0.27], 'photo': 0},
+            {'box': [0.54, 0.32, 0.42, 0.27], 'photo': 1},
+            {'box': [0.54, 0.61, 0.42, 0.27], 'photo': 2},
+        ],
+    },
+    # Сетка 2x2
+    'format_4': {
+        'size_in': [4, 6],
+        'slots': [
+            {'box': [0.04, 0.04, 0.44, 0.40], 'photo': 0},
+            {'box': [0.52, 0.04, 0.44, 0.40], 'photo': 1},
+            {'box': [0.04, 0.46, 0.44, 0.40], 'photo': 2},
+            {'box': [0.52, 0.46, 0.44, 0.40], 'photo': 3},
+        ],
+    },
+}
+
+OUTPUT_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+}
+
+
+class TemplateNotFound(ValueError):
+    """Неизвестный template_name"""
+
+
+# ============================================
+# ШАБЛОНЫ
+# ============================================
+
+def get_template(template_name):
+    """Описание шаблона: template.json из папки шаблона или встроенное"""
+    if not is_valid_template_name(template_name):
+        raise TemplateNotFound(f'Invalid template name: {template_name!r}')
+
+    definition_path = os.path.join(PRINT_TEMPLATES_DIR, template_name, 'template.json')
+    if os.path.isfile(definition_path):
+        with open(definition_path) as f:
+            return json.load(f)
+
+    if template_name not in TEMPLATES:
+        raise TemplateNotFound(f'Unknown template: {template_name}')
+    return TEMPLATES[template_name]
+
+
+def template_assets(template_name, size):
+    """(frame, mask) шаблона, приведённые к размеру листа"""
+    frame = template_asset_registry.get(template_name, 'frame', 'RGBA')
+    mask = template_asset_registry.get(template_name, 'mask', 'L')
+
+    if frame is not None and frame.size != size:
+        raise ValueError(f'frame.png of {template_name} must be {size[0]}x{size[1]}')
+    if mask is not None and mask.size != size:
+        raise ValueError(f'mask.png of {template_name} must be {size[0]}x{size[1]}')
+
+    return frame, mask
+
+
+# ============================================
+# СБОРКА ЛИСТА
+# ============================================
+
+def _slot_rect(box, sheet_size):
+    x, y, w, h = box
+    sheet_w, sheet_h = sheet_size
+    return (round(x * sheet_w), round(y * sheet_h), round(w * sheet_w), round(h * sheet_h))
+
+
+def compose(template_name, photos, output_format='jpeg', background=(255, 255, 255)):
+    """Собрать лист для печати
+
+    photos - список байтов фото в порядке слотов шаблона.
+    Возвращает {'data', 'width', 'height', 'mime_type', 'timings'}
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'format must be one of: {", ".join(OUTPUT_FORMATS)}')
+    if not photos:
+        raise ValueError('No photos to compose')
+
+    timings = {}
+    started = stage = time.perf_counter()
+
+    def mark(name):
+        nonlocal stage
+        now = time.perf_counter()
+        timings[name] = round((now - stage) * 1000, 1)
+        stage = now
+
+    template = get_template(template_name)
+    size = tuple(round(dim * PRINT_DPI) for dim in template['size_in'])
+    frame, mask = template_assets(template_name, size)
+    mark('assets_ms')
+
+    # Какие слоты занимает каждое фото - чтобы декодировать его сразу
+    # в масштабе самого большого слота (JPEG draft)
+    slots = []
+    largest = {}
+    for slot in template['slots']:
+        index = slot['photo'] % len(photos)
+        rect = _slot_rect(slot['box'], size)
+        slots.append((index, rect))
+        current = largest.get(index, (0, 0))
+        largest[index] = (max(current[0], rect[2]), max(current[1], rect[3]))
+
+    decoded = {}
+    for index, target in largest.items():
+        img = Image.open(BytesIO(photos[index]))
+        orientation = exif_orientation(img)
+        img.draft('RGB', target[::-1] if orientation in ROTATED_ORIENTATIONS else target)
+        if orientation != 1:
+            img = ImageOps.exif_transpose(img)
+        decoded[index] = img.convert('RGB') if img.mode != 'RGB' else img
+    mark('decode_ms')
+
+    sheet = Image.new('RGB', size, background)
+    tiles = {}
+    for index, (x, y, w, h) in slots:
+        # Одинаковые слоты (полоски-дубли) режем и масштабируем один раз
+        tile = tiles.get((index, w, h))
+        if tile is None:
+            tile = ImageOps.fit(decoded[index], (w, h), Image.Resampling.LANCZOS)
+            tiles[(index, w, h)] = tile
+        sheet.paste(tile, (x, y))
+    mark('place_ms')
+
+    if mask is not None:
+        sheet = Image.composite(sheet, Image.new('RGB', size, background), mask)
+    if frame is not None:
+        sheet.paste(frame, (0, 0), frame)
+    mark('overlay_ms')
+
+    pil_format, mime_type = OUTPUT_FORMATS[output_format]
+    buffer = BytesIO()
+    if pil_format == 'JPEG':
+        sheet.save(buffer, format=pil_format, quality=95, dpi=(PRINT_DPI, PRINT_DPI))
+    else:
+        sheet.save(buffer, format=pil_format, dpi=(PRINT_DPI, PRINT_DPI))
+    mark('encode_ms')
+
+    timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    return {
+        'data': buffer.getvalue(),
+        'width': size[0],
+        'height': size[1],
+        'mime_type': mime_type,
+        'timings': timings,
+    }
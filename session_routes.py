@@ -1,13 +1,325 @@
 """
 Endpoints для работы с сессиями Telegram бота
 """
-from flask import jsonify, request
+from flask import current_app, jsonify, request, send_file
 from datetime import datetime, timedelta
-from models import db, Session, SessionPhoto
+from io import BytesIO
+from PIL import Image
+from models import PHOTO_COUNTERS, db, Photo, Session, SessionPhoto
+from photo_storage import blob_store, decode_image_data_uri, detect_mime
+from image_derivatives import FORMATS, derivative_cache, parse_params, render
+from telegram_delivery import prewarm_photo_async
+from photo_retention import apply_retention, release_blobs
+from print_compositor import TemplateNotFound, compose
+from template_assets import is_valid_template_name
+from lazy_ingest import IngestError, ensure_ingested
+from write_queue import run_write
 import uuid
 import json
 import base64
+import hashlib
 import os
+import time
+
+# Отдача файлов через nginx (X-Accel-Redirect): internal location,
+# которая смотрит на PHOTO_STORAGE_DIR, например "/protected-photos/".
+# Для Apache/lighttpd вместо этого включите USE_X_SENDFILE в app.py
+PHOTO_ACCEL_REDIRECT_PREFIX = os.getenv('PHOTO_ACCEL_REDIRECT_PREFIX')
+
+
+def _store_photo_data(photo_data):
+    """Сохранить base64 фото в blob store
+
+    Возвращает (photo_path, photo_data) для SessionPhoto: если строку удалось
+    декодировать - байты уходят на диск и в БД остаётся только ссылка,
+    иначе строка сохраняется как раньше (старые клиенты).
+    """
+    data, _ = decode_image_data_uri(photo_data)
+    if data is None:
+        return None, photo_data
+    return blob_store.put(data), None
+
+
+# Заголовки для бинарной загрузки (application/octet-stream)
+PHOTO_FIELD_HEADERS = {
+    'photo_type': 'X-Photo-Type',
+    'width': 'X-Photo-Width',
+    'height': 'X-Photo-Height',
+    'order_index': 'X-Photo-Order',
+    'telegram_file_id': 'X-Telegram-File-Id',
+    'telegram_file_size': 'X-Telegram-File-Size',
+    'orientation': 'X-Photo-Orientation',
+    'original_width': 'X-Photo-Original-Width',
+    'original_height': 'X-Photo-Original-Height',
+    'taken_at': 'X-Photo-Taken-At',
+    'color_space': 'X-Photo-Color-Space',
+    'encode_quality': 'X-Photo-Encode-Quality',
+}
+
+PHOTO_INT_FIELDS = (
+    'width', 'height', 'order_index', 'telegram_file_size',
+    'orientation', 'original_width', 'original_height', 'encode_quality'
+)
+
+# Метаданные оригинала, которые бот считывает при загрузке
+PHOTO_METADATA_FIELDS = (
+    'orientation', 'original_width', 'original_height', 'taken_at', 'color_space', 'encode_quality'
+)
+
+# Лимиты загрузки гостем
+MAX_UPLOADED_PHOTOS = 5
+READY_PHOTO_COUNT = 3
+
+
+def _is_binary_upload():
+    """Тело запроса - это сами байты фото (а не JSON)"""
+    return request.mimetype == 'application/octet-stream' or request.mimetype.startswith('image/')
+
+
+def _photo_request_fields():
+    """Поля фото из запроса: JSON, multipart форма или заголовки
+
+    Для multipart/form-data и application/octet-stream поля берутся из
+    формы (или query string) и заголовков X-Photo-*, сами байты фото
+    читаются отдельно в _store_request_photo.
+    """
+    if request.mimetype == 'multipart/form-data':
+        source = request.form
+    elif _is_binary_upload():
+        source = request.args
+    else:
+        return request.get_json() or {}
+
+    fields = {}
+    for name, header in PHOTO_FIELD_HEADERS.items():
+        value = source.get(name, request.headers.get(header))
+        if value is None and name == 'order_index':
+            value = source.get('order')
+        if value is None or value == '':
+            continue
+        if name in PHOTO_INT_FIELDS:
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+        fields[name] = value
+    return fields
+
+
+def _store_request_photo(fields):
+    """Сохранить байты фото из запроса, вернуть (photo_path, photo_data)
+
+    multipart и octet-stream тела пишутся в blob store потоком кусками,
+    без base64 и без копии всего файла в памяти. ValueError если тело
+    или файл пустые (фото без байтов и без telegram_file_id для
+    отложенной загрузки)
+    """
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('photo') or request.files.get('file')
+        if not upload:
+            if fields.get('telegram_file_id'):
+                return None, None  # оригинал заберёт lazy_ingest
+            raise ValueError('Photo file is required')
+        photo_path = blob_store.put_stream(upload.stream)
+        if photo_path is None:
+            raise ValueError('Photo file is empty')
+        return photo_path, None
+    
+    if _is_binary_upload():
+        photo_path = blob_store.put_stream(request.stream)
+        if photo_path is None:
+            raise ValueError('Request body is empty')
+        return photo_path, None
+    
+    return _store_photo_data(fields.get('photo_data'))
+
+
+def _batch_request_items():
+    """Фото из batch запроса: JSON {"photos": [...]} или multipart
+
+    В multipart файлы передаются в повторяющемся поле "photos", а их
+    метаданные - в повторяющихся полях width/height/telegram_file_id
+    в том же порядке. Возвращает (photo_type, [поля фото]).
+    ValueError если в JSON "photos" не список объектов
+    """
+    if request.mimetype == 'multipart/form-data':
+        uploads = request.files.getlist('photos')
+        items = []
+        for idx, upload in enumerate(uploads):
+            item = {'upload': upload}
+            for name in ('width', 'height', 'telegram_file_id', 'telegram_file_size') + PHOTO_METADATA_FIELDS:
+                values = request.form.getlist(name)
+                if idx < len(values) and values[idx] != '':
+                    item[name] = values[idx]
+            for name in PHOTO_INT_FIELDS:
+                if name in item:
+                    try:
+                        item[name] = int(item[name])
+                    except ValueError:
+                        del item[name]
+            items.append(item)
+        return request.form.get('photo_type', 'uploaded'), items
+    
+    data = request.get_json() or {}
+    photos = data.get('photos') or []
+    if not isinstance(photos, list) or not all(isinstance(item, dict) for item in photos):
+        raise ValueError('photos must be a list of objects')
+    return data.get('photo_type', 'uploaded'), photos
+
+
+def _store_batch_item(item):
+    """Сохранить байты одного фото из batch, вернуть (photo_path, photo_data)"""
+    if 'upload' in item:
+        return blob_store.put_stream(item['upload'].stream), None
+    return _store_photo_data(item.get('photo_data'))
+
+
+def _photo_projection():
+    """Параметры проекции из query string: ?fields=id,width&include_data=0
+
+    Возвращает (fields, include_data). Если fields указан без photo_data,
+    байты фото не загружаются из хранилища.
+    """
+    fields = request.args.get('fields')
+    if fields:
+        fields = [name.strip() for name in fields.split(',') if name.strip()]
+    else:
+        fields = None
+    
+    include_data = request.args.get('include_data')
+    if include_data is not None:
+        include_data = include_data.lower() not in ('0', 'false', 'no')
+    else:
+        include_data = fields is None or 'photo_data' in fields
+    
+    return fields, include_data
+
+
+def _send_photo(photo):
+    """Отдать байты фото: Range, ETag (SHA-256 содержимого), 304, sendfile"""
+    if photo.photo_path and blob_store.exists(photo.photo_path):
+        etag = blob_store.digest_of(photo.photo_path)
+        mimetype = blob_store.mime(photo.photo_path)
+        
+        if PHOTO_ACCEL_REDIRECT_PREFIX:
+            # Байты отдаёт nginx (включая Range), мы только проверяем ETag
+            response = current_app.response_class(mimetype=mimetype)
+            response.set_etag(etag)
+            response.headers['X-Accel-Redirect'] = PHOTO_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + photo.photo_path
+            return response.make_conditional(request)
+        
+        # send_file сам обрабатывает Range/If-None-Match и USE_X_SENDFILE
+        return send_file(blob_store.path(photo.photo_path), mimetype=mimetype, etag=etag, conditional=True)
+    
+    # Старые фото с base64 в БД
+    data = photo.read_bytes()
+    if data is None:
+        return jsonify({'error': 'Photo data not available'}), 404
+    
+    return send_file(
+        BytesIO(data),
+        mimetype=detect_mime(data),
+        etag=hashlib.sha256(data).hexdigest(),
+        conditional=True
+    )
+
+
+def _send_derivative(photo, params):
+    """Отдать производную фото из дискового кэша (генерируется при первом запросе)"""
+    digest = _photo_digest(photo)
+    if not digest:
+        return jsonify({'error': 'Photo data not available'}), 404
+    
+    key = derivative_cache.key_for(digest, params)
+    
+    for attempt in range(2):
+        try:
+            path = derivative_cache.get_or_create(
+                key, params['format'], lambda: render(photo.read_bytes(), params)
+            )
+        except Image.DecompressionBombError:
+            return jsonify({'error': 'Image is too large'}), 422
+        except OSError as e:
+            print(f"❌ Derivative error for photo {photo.id}: {e}", flush=True)
+            return jsonify({'error': 'Unsupported image'}), 415
+        
+        try:
+            # send_file открывает файл сразу - дальше вытеснение ему не мешает
+            response = send_file(path, mimetype=FORMATS[params['format']][1], etag=key, conditional=True)
+            break
+        except FileNotFoundError:
+            # Производную вытеснили между созданием и отправкой - генерируем заново
+            if attempt:
+                raise
+    
+    if params['negotiated']:
+        response.vary.add('Accept')
+    return response
+
+
+class SessionGone(LookupError):
+    """Сессию удалили между проверкой в запросе и единицей записи"""
+
+
+class PhotoGone(LookupError):
+    """Фото удалили между проверкой в запросе и единицей записи"""
+
+
+def _write_session(session_id):
+    """Сессия внутри единицы записи; SessionGone если её уже нет"""
+    session = db.session.get(Session, session_id, populate_existing=True)
+    if session is None:
+        raise SessionGone(session_id)
+    return session
+
+
+def _lock_session(session_id):
+    """Заблокировать строку сессии до конца транзакции, вернуть свежую сессию
+    
+    В SQLite - write lock всей БД, в PostgreSQL - блокировка строки.
+    Параллельные записи в одну сессию выполняются по очереди, поэтому
+    лимит фото и order_index проверяются без гонок.
+    """
+    db.session.execute(
+        db.update(Session).where(Session.id == session_id).values(status=Session.status)
+    )
+    # Счётчики перечитываем уже под блокировкой
+    return _write_session(session_id)
+
+
+def _next_order_index(session_id, photo_type):
+    """Следующий свободный order_index для фото этого типа"""
+    max_order = db.session.query(db.func.max(SessionPhoto.order_index)).filter_by(
+        session_id=session_id, photo_type=photo_type
+    ).scalar()
+    return 0 if max_order is None else max_order + 1
+
+
+def _photo_metadata(fields, photo_path):
+    """Метаданные для SessionPhoto: EXIF поля от клиента + размер файла"""
+    metadata = {name: fields.get(name) for name in PHOTO_METADATA_FIELDS}
+    
+    taken_at = metadata.get('taken_at')
+    if taken_at:
+        try:
+            metadata['taken_at'] = datetime.fromisoformat(taken_at)
+        except (TypeError, ValueError):
+            metadata['taken_at'] = None
+    
+    if photo_path and blob_store.exists(photo_path):
+        metadata['byte_size'] = os.path.getsize(blob_store.path(photo_path))
+    
+    return metadata
+
+
+def _photo_digest(photo):
+    """SHA-256 содержимого фото (для ETag и ключей кэша)"""
+    if photo.photo_path and blob_store.exists(photo.photo_path):
+        return blob_store.digest_of(photo.photo_path)
+    data = photo.read_bytes()
+    if data is None:
+        return None
+    return hashlib.sha256(data).hexdigest()
 
 
 def init_session_routes(app):
@@ -40,23 +352,26 @@ def init_session_routes(app):
         # Сессия истекает через 30 минут
         expires_at = datetime.utcnow() + timedelta(minutes=30)
         
-        session = Session(
-            id=session_id,
-            kiosk_id=data.get('kiosk_id'),
-            type=session_type,
-            status='pending',
-            expires_at=expires_at,
-            data=json.dumps(data.get('data', {}))
-        )
+        def write():
+            session = Session(
+                id=session_id,
+                kiosk_id=data.get('kiosk_id'),
+                type=session_type,
+                status='pending',
+                expires_at=expires_at,
+                data=json.dumps(data.get('data', {}))
+            )
+            db.session.add(session)
+            db.session.flush()
+            return session.to_dict()
         
-        db.session.add(session)
-        db.session.commit()
+        session_dict = run_write(write)
         
         print(f"✅ Session created: {session_id} ({session_type})", flush=True)
         
         return jsonify({
             'success': True,
-            'session': session.to_dict()
+            'session': session_dict
         }), 201
     
     # ============================================
@@ -102,25 +417,31 @@ def init_session_routes(app):
         
         data = request.get_json()
         
-        if 'status' in data:
-            session.status = data['status']
-            if data['status'] == 'completed':
-                session.completed_at = datetime.utcnow()
-        
-        if 'telegram_user_id' in data:
-            session.telegram_user_id = data['telegram_user_id']
-        
-        if 'telegram_username' in data:
-            session.telegram_username = data['telegram_username']
-        
-        if 'data' in data:
-            session.data = json.dumps(data['data'])
+        def write():
+            session = _write_session(session_id)
+            
+            if 'status' in data:
+                session.status = data['status']
+                if data['status'] == 'completed':
+                    session.completed_at = datetime.utcnow()
+            
+            if 'telegram_user_id' in data:
+                session.telegram_user_id = data['telegram_user_id']
+            
+            if 'telegram_username' in data:
+                session.telegram_username = data['telegram_username']
+            
+            if 'data' in data:
+                session.data = json.dumps(data['data'])
         
-        db.session.commit()
+        try:
+            run_write(write)
+        except SessionGone:
+            return jsonify({'error': 'Session not found'}), 404
         
         print(f"✅ Session updated: {session_id}", flush=True)
         
-        return jsonify(session.to_dict())
+        return jsonify(Session.query.get(session_id).to_dict())
     
     # ============================================
     # УДАЛЕНИЕ СЕССИИ
@@ -134,8 +455,16 @@ def init_session_routes(app):
         if not session:
             return jsonify({'error': 'Session not found'}), 404
         
-        db.session.delete(session)
-        db.session.commit()
+        def write():
+            session = _write_session(session_id)
+            refs = [photo.photo_path for photo in session.photos]
+            db.session.delete(session)
+            return refs
+        
+        try:
+            release_blobs(run_write(write))
+        except SessionGone:
+            return jsonify({'error': 'Session not found'}), 404
         
         print(f"✅ Session deleted: {session_id}", flush=True)
         
@@ -149,7 +478,7 @@ def init_session_routes(app):
     def add_session_photo(session_id):
         """Добавить фото в сессию (от Telegram бота)
         
-        Body:
+        Body (JSON):
         {
             "photo_type": "uploaded" | "result",
             "photo_data": "base64_string" (опционально),
@@ -159,6 +488,11 @@ def init_session_routes(app):
             "height": 1080,
             "order_index": 0
         }
+        
+        Или без base64:
+        - multipart/form-data: файл в поле "photo", остальные поля - в форме
+        - application/octet-stream: тело = байты фото, поля - в заголовках
+          X-Photo-Type, X-Photo-Width, X-Photo-Height, X-Photo-Order
         """
         session = Session.query.get(session_id)
         
@@ -168,46 +502,187 @@ def init_session_routes(app):
         if session.is_expired:
             return jsonify({'error': 'Session expired'}), 410
         
-        data = request.get_json()
+        data = _photo_request_fields()
         
         # Проверка лимита фото (макс 5 uploaded фото)
         if data.get('photo_type') == 'uploaded':
-            uploaded_count = session.photos.filter_by(photo_type='uploaded').count()
-            if uploaded_count >= 5:
-                return jsonify({'error': 'Maximum 5 photos allowed'}), 400
-        
-        # Создаём фото
-        photo = SessionPhoto(
-            session_id=session_id,
-            photo_type=data.get('photo_type', 'uploaded'),
-            photo_data=data.get('photo_data'),
-            telegram_file_id=data.get('telegram_file_id'),
-            telegram_file_size=data.get('telegram_file_size'),
-            width=data.get('width'),
-            height=data.get('height'),
-            order_index=data.get('order_index', 0)
-        )
+            if session.uploaded_count >= MAX_UPLOADED_PHOTOS:
+                return jsonify({'error': f'Maximum {MAX_UPLOADED_PHOTOS} photos allowed'}), 400
         
-        db.session.add(photo)
+        # Байты фото пишем в blob store, в БД - только ссылка
+        try:
+            photo_path, photo_data = _store_request_photo(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        metadata = _photo_metadata(data, photo_path)
+        fields, include_data = _photo_projection()
         
-        # Если загружены все фото (например, 3), ставим статус ready
-        uploaded_count = session.photos.filter_by(photo_type='uploaded').count()
-        if data.get('photo_type') == 'uploaded' and uploaded_count + 1 >= 3:
-            session.status = 'ready'
+        photo_type = data.get('photo_type', 'uploaded')
         
-        db.session.commit()
+        def write():
+            # Лимит и order_index - под блокировкой сессии (проверка выше
+            # только экономит запись blob'а в заведомо лишнем запросе)
+            session = _lock_session(session_id)
+            if photo_type == 'uploaded' and session.uploaded_count >= MAX_UPLOADED_PHOTOS:
+                return None
+            
+            # order_index клиента, если он свободен, иначе следующий
+            order_index = data.get('order_index')
+            if order_index is None or SessionPhoto.query.filter_by(
+                session_id=session_id, photo_type=photo_type, order_index=order_index
+            ).first():
+                order_index = _next_order_index(session_id, photo_type)
+            
+            # Создаём фото
+            photo = SessionPhoto(
+                session_id=session_id,
+                photo_type=photo_type,
+                photo_path=photo_path,
+                photo_data=photo_data,
+                telegram_file_id=data.get('telegram_file_id'),
+                telegram_file_size=data.get('telegram_file_size'),
+                width=data.get('width'),
+                height=data.get('height'),
+                order_index=order_index,
+                **metadata
+            )
+            
+            db.session.add(photo)
+            db.session.flush()  # счётчик сессии обновляется вместе со вставкой
+            
+            # Если загружены все фото (например, 3), ставим статус ready
+            if photo.photo_type == 'uploaded' and session.uploaded_count >= READY_PHOTO_COUNT:
+                session.status = 'ready'
+            # Только id: to_dict с photo_data читал бы blob под блокировкой записи
+            return photo.id
+        
+        try:
+            photo_id = run_write(write)
+        except SessionGone:
+            release_blobs([photo_path])
+            return jsonify({'error': 'Session not found'}), 404
         
-        print(f"✅ Photo added to session {session_id}: {photo.id}", flush=True)
+        if photo_id is None:
+            release_blobs([photo_path])
+            return jsonify({'error': f'Maximum {MAX_UPLOADED_PHOTOS} photos allowed'}), 400
+        
+        print(f"✅ Photo added to session {session_id}: {photo_id}", flush=True)
         
         return jsonify({
             'success': True,
-            'photo': photo.to_dict(),
-            'session': session.to_dict()
+            'photo': SessionPhoto.query.get(photo_id).to_dict(fields=fields, include_data=include_data),
+            'session': Session.query.get(session_id).to_dict()
+        }), 201
+    
+    @app.route('/api/session/<session_id>/photos/batch', methods=['POST'])
+    def add_session_photos_batch(session_id):
+        """Добавить несколько фото одним запросом и одной транзакцией
+        
+        Body (JSON):
+        {
+            "photo_type": "uploaded",
+            "photos": [
+                {"photo_data": "base64_string", "width": 1920, "height": 1080},
+                ...
+            ]
+        }
+        
+        Или multipart/form-data: файлы в повторяющемся поле "photos",
+        width/height - повторяющимися полями в том же порядке.
+        
+        order_index назначает сервер (продолжая уже загруженные фото)
+        """
+        session = Session.query.get(session_id)
+        
+        if not session:
+            return jsonify({'error': 'Session not found'}), 404
+        
+        if session.is_expired:
+            return jsonify({'error': 'Session expired'}), 410
+        
+        try:
+            photo_type, items = _batch_request_items()
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        if not items:
+            return jsonify({'error': 'No photos in request'}), 400
+        
+        # Байты пишем на диск до транзакции, чтобы не держать блокировку БД на IO
+        stored = [_store_batch_item(item) for item in items]
+        metadata = [_photo_metadata(item, photo_path) for item, (photo_path, _) in zip(items, stored)]
+        
+        fields, include_data = _photo_projection()
+        if request.args.get('include_data') is None and 'photo_data' not in (fields or []):
+            include_data = False  # не отправляем только что загруженные байты обратно
+        
+        def write():
+            # Блокировка до подсчёта - параллельные запросы не получат
+            # одинаковые order_index и не превысят лимит
+            session = _lock_session(session_id)
+            type_count = session.photo_count(photo_type) if photo_type in PHOTO_COUNTERS else 0
+            
+            if photo_type == 'uploaded' and type_count + len(items) > MAX_UPLOADED_PHOTOS:
+                return type_count, None
+            
+            next_order = _next_order_index(session_id, photo_type)
+            
+            photos = []
+            for idx, (item, (photo_path, photo_data)) in enumerate(zip(items, stored)):
+                photo = SessionPhoto(
+                    session_id=session_id,
+                    photo_type=photo_type,
+                    photo_path=photo_path,
+                    photo_data=photo_data,
+                    telegram_file_id=item.get('telegram_file_id'),
+                    telegram_file_size=item.get('telegram_file_size'),
+                    width=item.get('width'),
+                    height=item.get('height'),
+                    order_index=next_order + idx,
+                    **metadata[idx]
+                )
+                db.session.add(photo)
+                photos.append(photo)
+            
+            # Статус меняется в том же commit что и вставка фото
+            if photo_type == 'uploaded' and type_count + len(items) >= READY_PHOTO_COUNT:
+                session.status = 'ready'
+            
+            db.session.flush()
+            return type_count, [photo.id for photo in photos]
+        
+        try:
+            type_count, photo_ids = run_write(write)
+        except SessionGone:
+            release_blobs([photo_path for photo_path, _ in stored])
+            return jsonify({'error': 'Session not found'}), 404
+        
+        if photo_ids is None:
+            release_blobs([photo_path for photo_path, _ in stored])
+            return jsonify({
+                'error': f'Maximum {MAX_UPLOADED_PHOTOS} photos allowed',
+                'uploaded_count': type_count
+            }), 400
+        
+        print(f"✅ {len(photo_ids)} photos added to session {session_id}", flush=True)
+        
+        photos = SessionPhoto.query.filter(SessionPhoto.id.in_(photo_ids)).order_by(SessionPhoto.order_index).all()
+        
+        return jsonify({
+            'success': True,
+            'photos': [photo.to_dict(fields=fields, include_data=include_data) for photo in photos],
+            'session': Session.query.get(session_id).to_dict()
         }), 201
     
     @app.route('/api/session/<session_id>/photos', methods=['GET'])
     def get_session_photos(session_id):
-        """Получить все фото сессии"""
+        """Получить все фото сессии
+        
+        Query:
+            type=uploaded|result
+            fields=id,width,height (только эти поля)
+            include_data=0 (без photo_data - только метаданные)
+        """
         session = Session.query.get(session_id)
         
         if not session:
@@ -217,28 +692,183 @@ def init_session_routes(app):
             return jsonify({'error': 'Session expired'}), 410
         
         photo_type = request.args.get('type')  # uploaded или result
+        fields, include_data = _photo_projection()
         
+        query = session.photos
         if photo_type:
-            photos = session.photos.filter_by(photo_type=photo_type).order_by(SessionPhoto.order_index).all()
-        else:
-            photos = session.photos.order_by(SessionPhoto.order_index).all()
+            query = query.filter_by(photo_type=photo_type)
+        if include_data:
+            # Старые base64 фото - одним запросом, а не по запросу на строку
+            query = query.options(db.undefer(SessionPhoto.photo_data))
+        photos = query.order_by(SessionPhoto.order_index).all()
+        
+        if include_data:
+            for photo in photos:
+                try:
+                    ensure_ingested(photo)
+                except IngestError:
+                    pass  # photo_data будет null, остальные фото отдаём
         
         return jsonify({
             'success': True,
             'session_id': session_id,
-            'photos': [photo.to_dict() for photo in photos]
+            'photos': [photo.to_dict(fields=fields, include_data=include_data) for photo in photos]
+        })
+    
+    @app.route('/api/session/<session_id>/photos/<int:photo_id>', methods=['PATCH'])
+    def update_session_photo(session_id, photo_id):
+        """Обновить Telegram данные фото (от бота после первой отправки)
+        
+        Body:
+        {
+            "telegram_file_id": "file_id",
+            "telegram_file_size": 123456
+        }
+        """
+        session = Session.query.get(session_id)
+        
+        if not session:
+            return jsonify({'error': 'Session not found'}), 404
+        
+        photo = session.photos.filter_by(id=photo_id).first()
+        
+        if not photo:
+            return jsonify({'error': 'Photo not found'}), 404
+        
+        data = request.get_json() or {}
+        
+        def write():
+            photo = db.session.get(SessionPhoto, photo_id)
+            if photo is None:
+                raise PhotoGone(photo_id)
+            
+            if 'telegram_file_id' in data:
+                photo.telegram_file_id = data['telegram_file_id']
+            
+            if 'telegram_file_size' in data:
+                photo.telegram_file_size = data['telegram_file_size']
+        
+        try:
+            run_write(write)
+        except PhotoGone:
+            return jsonify({'success': False, 'error': 'Photo not found'}), 404
+        
+        return jsonify({
+            'success': True,
+            'photo': db.session.get(SessionPhoto, photo_id).to_dict(include_data=False)
         })
     
+    @app.route('/api/session/<session_id>/photos/<int:photo_id>/file', methods=['GET'])
+    def get_session_photo_file(session_id, photo_id):
+        """Получить фото как файл (байты с правильным Content-Type)
+        
+        Поддерживает Range (докачка), ETag/If-None-Match (304)
+        и X-Sendfile/X-Accel-Redirect за reverse proxy
+        
+        Query:
+            без format - оригинал как есть (печать, file_url)
+            format=auto|avif|webp|jpeg|png - перекодировать в полном размере
+                (auto - по Accept; если клиент не просит AVIF/WebP,
+                отдаётся оригинал)
+            quality=80
+            purpose=print - всегда оригинал, даже с format
+        """
+        session = Session.query.get(session_id)
+        
+        if not session:
+            return jsonify({'error': 'Session not found'}), 404
+        
+        if session.is_expired:
+            return jsonify({'error': 'Session expired'}), 410
+        
+        photo = session.photos.filter_by(id=photo_id).first()
+        
+        if not photo:
+            return jsonify({'error': 'Photo not found'}), 404
+        
+        if photo.purged_at:
+            return jsonify({'error': 'Photo data expired'}), 410
+        
+        # Ленивый режим: оригинал скачивается из Telegram при первом запросе
+        try:
+            ensure_ingested(photo)
+        except IngestError:
+            return jsonify({'error': 'Photo is not available from Telegram'}), 502
+        
+        # Перекодирование только по явной просьбе клиента: Accept браузера
+        # не должен подменять оригинал, который уходит на печать
+        if not request.args.get('format') or request.args.get('purpose') == 'print':
+            return _send_photo(photo)
+        
+        try:
+            params = parse_params(request.args, request.accept_mimetypes, require_size=False)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if params['negotiated'] and params['format'] == 'jpeg':
+            # Клиент не умеет AVIF/WebP - оригинал без потерь на перекодировании
+            response = _send_photo(photo)
+            if isinstance(response, tuple):
+                return response
+            response.vary.add('Accept')
+            return response
+        
+        return _send_derivative(photo, params)
+    
+    @app.route('/api/session/<session_id>/photos/<int:photo_id>/preview', methods=['GET'])
+    def get_session_photo_preview(session_id, photo_id):
+        """Получить уменьшенную копию фото (превью для фотобудки)
+        
+        Query:
+            w=400, h=300 (хотя бы один)
+            fit=contain|cover|fill
+            format=auto|avif|webp|jpeg|png (auto или без format - по Accept)
+            quality=80
+        
+        Каждая копия генерируется один раз и берётся из дискового кэша
+        """
+        session = Session.query.get(session_id)
+        
+        if not session:
+            return jsonify({'error': 'Session not found'}), 404
+        
+        if session.is_expired:
+            return jsonify({'error': 'Session expired'}), 410
+        
+        photo = session.photos.filter_by(id=photo_id).first()
+        
+        if not photo:
+            return jsonify({'error': 'Photo not found'}), 404
+        
+        if photo.purged_at:
+            return jsonify({'error': 'Photo data expired'}), 410
+        
+        # Ленивый режим: оригинал скачивается из Telegram при первом запросе
+        try:
+            ensure_ingested(photo)
+        except IngestError:
+            return jsonify({'error': 'Photo is not available from Telegram'}), 502
+        
+        try:
+            params = parse_params(request.args, request.accept_mimetypes)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return _send_derivative(photo, params)
+    
     @app.route('/api/session/<session_id>/result', methods=['POST'])
     def save_result_photo(session_id):
         """Сохранить готовое фото (от фотобудки)
         
-        Body:
+        Body (JSON):
         {
             "photo_data": "base64_string",
             "width": 1920,
             "height": 1080
         }
+        
+        Также принимает multipart/form-data и application/octet-stream
+        (как /api/session/<id>/photos)
         """
         session = Session.query.get(session_id)
         
@@ -248,26 +878,157 @@ def init_session_routes(app):
         if session.is_expired:
             return jsonify({'error': 'Session expired'}), 410
         
-        data = request.get_json()
+        data = _photo_request_fields()
         
-        photo = SessionPhoto(
-            session_id=session_id,
-            photo_type='result',
-            photo_data=data.get('photo_data'),
-            width=data.get('width'),
-            height=data.get('height'),
-            order_index=0
-        )
+        try:
+            photo_path, photo_data = _store_request_photo(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        metadata = _photo_metadata(data, photo_path)
+        fields, include_data = _photo_projection()
         
-        db.session.add(photo)
-        session.status = 'ready'  # Готово к скачиванию
-        db.session.commit()
+        def write():
+            photo = SessionPhoto(
+                session_id=session_id,
+                photo_type='result',
+                photo_path=photo_path,
+                photo_data=photo_data,
+                width=data.get('width'),
+                height=data.get('height'),
+                order_index=0,
+                **metadata
+            )
+            
+            db.session.add(photo)
+            _write_session(session_id).status = 'ready'  # Готово к скачиванию
+            db.session.flush()
+            return photo.id
+        
+        try:
+            photo_id = run_write(write)
+        except SessionGone:
+            release_blobs([photo_path])
+            return jsonify({'error': 'Session not found'}), 404
         
         print(f"✅ Result photo saved for session {session_id}", flush=True)
         
+        # Заранее загружаем в Telegram, чтобы гость получил фото по file_id
+        prewarm_photo_async(app, photo_id)
+        
         return jsonify({
             'success': True,
-            'photo': photo.to_dict()
+            'photo': SessionPhoto.query.get(photo_id).to_dict(fields=fields, include_data=include_data)
+        }), 201
+    
+    @app.route('/api/session/<session_id>/compose', methods=['POST'])
+    def compose_print_sheet(session_id):
+        """Собрать лист для печати по шаблону и сохранить как result фото
+        
+        Body:
+        {
+            "template_name": "format_3",
+            "photo_ids": [1, 2, 3] (опционально, по умолчанию - uploaded фото),
+            "format": "jpeg" | "png",
+            "copy_count": 2,
+            "payment_id": 15 (опционально)
+        }
+        """
+        session = Session.query.get(session_id)
+        
+        if not session:
+            return jsonify({'error': 'Session not found'}), 404
+        
+        if session.is_expired:
+            return jsonify({'error': 'Session expired'}), 410
+        
+        data = request.get_json() or {}
+        
+        template_name = data.get('template_name')
+        if not template_name:
+            return jsonify({'error': 'template_name is required'}), 400
+        if not is_valid_template_name(template_name):
+            return jsonify({'error': 'template_name may contain only letters, digits, "_" and "-"'}), 400
+        
+        photo_ids = data.get('photo_ids')
+        if photo_ids is not None and not (
+            isinstance(photo_ids, list) and photo_ids
+            and all(isinstance(photo_id, int) and not isinstance(photo_id, bool) for photo_id in photo_ids)
+        ):
+            return jsonify({'success': False, 'error': 'photo_ids must be a non-empty list of integers'}), 400
+        
+        if photo_ids:
+            by_id = {
+                photo.id: photo
+                for photo in session.photos.filter(SessionPhoto.id.in_(photo_ids)).all()
+            }
+            source_photos = [by_id[photo_id] for photo_id in photo_ids if photo_id in by_id]
+        else:
+            source_photos = session.photos.filter_by(photo_type='uploaded').order_by(SessionPhoto.order_index).all()
+        
+        try:
+            for photo in source_photos:
+                ensure_ingested(photo)
+        except IngestError:
+            return jsonify({'error': 'Photo is not available from Telegram'}), 502
+        
+        sources = [photo.read_bytes() for photo in source_photos]
+        sources = [source for source in sources if source]
+        
+        if not sources:
+            return jsonify({'error': 'No photos to compose'}), 400
+        
+        try:
+            sheet = compose(template_name, sources, output_format=data.get('format', 'jpeg'))
+        except TemplateNotFound as e:
+            return jsonify({'error': str(e)}), 404
+        except Image.DecompressionBombError:
+            return jsonify({'error': 'Image is too large'}), 422
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        started = time.perf_counter()
+        photo_path = blob_store.put(sheet['data'])
+        
+        def write():
+            result_photo = SessionPhoto(
+                session_id=session_id,
+                photo_type='result',
+                photo_path=photo_path,
+                width=sheet['width'],
+                height=sheet['height'],
+                order_index=0,
+                byte_size=len(sheet['data'])
+            )
+            print_record = Photo(
+                payment_id=data.get('payment_id'),
+                template_name=template_name,
+                copy_count=data.get('copy_count', 1),
+                composite_path=photo_path
+            )
+            
+            db.session.add(result_photo)
+            db.session.add(print_record)
+            _write_session(session_id).status = 'ready'  # Готово к скачиванию
+            db.session.flush()
+            return result_photo.id, print_record.id
+        
+        try:
+            photo_id, print_id = run_write(write)
+        except SessionGone:
+            release_blobs([photo_path])
+            return jsonify({'error': 'Session not found'}), 404
+        
+        sheet['timings']['store_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        
+        print(f"✅ Print sheet composed for session {session_id}: {template_name} {sheet['timings']}", flush=True)
+        
+        prewarm_photo_async(app, photo_id)
+        
+        return jsonify({
+            'success': True,
+            'photo': SessionPhoto.query.get(photo_id).to_dict(include_data=False),
+            'print': Photo.query.get(print_id).to_dict(),
+            'timings': sheet['timings']
         }), 201
     
     @app.route('/api/session/<session_id>/result', methods=['GET'])
@@ -286,7 +1047,9 @@ def init_session_routes(app):
         if not result_photo:
             return jsonify({'error': 'Result photo not found'}), 404
         
-        return jsonify(result_photo.to_dict())
+        fields, include_data = _photo_projection()
+        
+        return jsonify(result_photo.to_dict(fields=fields, include_data=include_data))
     
     # ============================================
     # УТИЛИТЫ
@@ -298,11 +1061,15 @@ def init_session_routes(app):
         expired = Session.query.filter(Session.expires_at < datetime.utcnow()).all()
         
         count = len(expired)
+        refs = []
         for session in expired:
+            refs.extend(photo.photo_path for photo in session.photos)
             db.session.delete(session)
         
         db.session.commit()
         
+        release_blobs(refs)
+        
         print(f"✅ Cleaned up {count} expired sessions", flush=True)
         
         return jsonify({
@@ -310,6 +1077,26 @@ def init_session_routes(app):
             'deleted_count': count
         })
     
+    @app.route('/api/photos/retention', methods=['POST'])
+    def apply_photo_retention():
+        """Удалить байты старых фото по политикам хранения (можно вызывать по cron)
+        
+        Query: dry_run=1 - только посчитать, ничего не удалять
+        """
+        dry_run = request.args.get('dry_run', '0').lower() in ('1', 'true', 'yes')
+        report = apply_retention(dry_run=dry_run)
+        
+        print(
+            f"✅ Retention: purged {report['purged']}, evicted {report['evicted_for_budget']}, "
+            f"reclaimed {report['reclaimed_bytes']} bytes",
+            flush=True
+        )
+        
+        return jsonify({
+            'success': True,
+            **report
+        })
+    
     @app.route('/api/sessions/list', methods=['GET'])
     def list_sessions():
         """Получить список всех активных сессий (для дебага)"""
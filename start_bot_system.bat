@@ -42,6 +42,14 @@ echo Нажмите Ctrl+C для остановки
 echo ============================================================
 echo.
 
+REM Миграции схемы БД (сервер не стартует со старой схемой)
+python migrations.py
+if %errorlevel% neq 0 (
+    echo ❌ Ошибка миграции БД
+    pause
+    exit /b 1
+)
+
 python app.py
 
 pause
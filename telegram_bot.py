@@ -7,9 +7,9 @@ import telebot
 from telebot import types
 import requests
 import os
-import base64
-from io import BytesIO
-from PIL import Image
+
+from image_pipeline import image_pipeline, ImageTooLarge, PipelineBusy, PipelineTimeout, UnsupportedImage
+from telegram_download import MAX_UPLOAD_BYTES, UploadTooLarge, download_to_spool
 
 # ============================================
 # КОНФИГУРАЦИЯ
@@ -18,6 +18,13 @@ from PIL import Image
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '8565934485:AAELT16NMIp12QX_C7bzN7vXt63NX4ITraU')
 API_URL = os.getenv('API_URL', 'http://localhost:5000/api')
 
+# iPhone иногда присылает HEIC как application/octet-stream
+HEIF_EXTENSIONS = ('.heic', '.heif', '.avif')
+
+# Ленивая загрузка: бот сохраняет только file_id и размеры, оригинал
+# скачивает backend когда фото впервые понадобится фотобудке
+LAZY_INGEST = os.getenv('LAZY_INGEST', '0') == '1'
+
 bot = telebot.TeleBot(BOT_TOKEN)
 
 # Хранилище для отслеживания сессий пользователей
@@ -47,19 +54,38 @@ def update_session(session_id, data):
         print(f"Error updating session: {e}")
         return False
 
-def add_photo_to_session(session_id, photo_data):
-    """Добавить фото в сессию"""
+def add_photo_to_session(session_id, photo_data, image_bytes=None):
+    """Добавить фото в сессию
+    
+    Если переданы image_bytes - отправляем их как multipart файл (без base64).
+    Байты фото обратно в ответе не нужны (include_data=0)
+    """
     try:
-        response = requests.post(f"{API_URL}/session/{session_id}/photos", json=photo_data)
+        if image_bytes is not None:
+            response = requests.post(
+                f"{API_URL}/session/{session_id}/photos",
+                params={'include_data': 0},
+                data=photo_data,
+                files={'photo': ('photo.jpg', image_bytes, 'image/jpeg')}
+            )
+        else:
+            response = requests.post(
+                f"{API_URL}/session/{session_id}/photos",
+                params={'include_data': 0},
+                json=photo_data
+            )
         return response.status_code == 201
     except Exception as e:
         print(f"Error adding photo: {e}")
         return False
 
 def get_session_photos(session_id, photo_type='result'):
-    """Получить фото из сессии"""
+    """Получить список фото из сессии (только метаданные, без photo_data)"""
     try:
-        response = requests.get(f"{API_URL}/session/{session_id}/photos?type={photo_type}")
+        response = requests.get(
+            f"{API_URL}/session/{session_id}/photos",
+            params={'type': photo_type, 'include_data': 0}
+        )
         if response.status_code == 200:
             return response.json().get('photos', [])
         return []
@@ -67,6 +93,29 @@ def get_session_photos(session_id, photo_type='result'):
         print(f"Error getting photos: {e}")
         return []
 
+def set_photo_file_id(session_id, photo_id, file_id, file_size=None):
+    """Запомнить Telegram file_id фото, чтобы больше не загружать байты"""
+    try:
+        response = requests.patch(
+            f"{API_URL}/session/{session_id}/photos/{photo_id}",
+            json={'telegram_file_id': file_id, 'telegram_file_size': file_size}
+        )
+        return response.status_code == 200
+    except Exception as e:
+        print(f"Error saving file_id: {e}")
+        return False
+
+def get_photo_file(session_id, photo_id):
+    """Скачать байты фото из сессии"""
+    try:
+        response = requests.get(f"{API_URL}/session/{session_id}/photos/{photo_id}/file")
+        if response.status_code == 200:
+            return response.content
+        return None
+    except Exception as e:
+        print(f"Error downloading photo: {e}")
+        return None
+
 # ============================================
 # ОБРАБОТЧИКИ КОМАНД
 # ============================================
@@ -179,22 +228,30 @@ def handle_download_start(message, session_id):
     # Отправляем каждое фото КАК ДОКУМЕНТ (без сжатия!)
     for idx, photo in enumerate(photos):
         try:
-            # Декодируем base64 в изображение
-            photo_data = photo.get('photo_data')
-            if photo_data:
-                # Убираем prefix если есть (data:image/jpeg;base64,)
-                if ',' in photo_data:
-                    photo_data = photo_data.split(',')[1]
-                
-                image_bytes = base64.b64decode(photo_data)
-                
-                # Отправляем КАК ДОКУМЕНТ для максимального качества!
+            caption = f"📷 Фото {idx + 1}/{len(photos)} в высоком качестве!"
+            
+            # Фото уже есть в Telegram - отправляем по file_id, без загрузки
+            if photo.get('telegram_file_id'):
                 bot.send_document(
+                    message.chat.id,
+                    document=photo['telegram_file_id'],
+                    caption=caption
+                )
+                continue
+            
+            # Скачиваем байты фото напрямую (без base64 в JSON)
+            image_bytes = get_photo_file(session_id, photo['id'])
+            if image_bytes:
+                # Отправляем КАК ДОКУМЕНТ для максимального качества!
+                sent = bot.send_document(
                     message.chat.id,
                     document=image_bytes,
                     visible_file_name=f'photobooth_photo_{idx + 1}.jpg',
-                    caption=f"📷 Фото {idx + 1}/{len(photos)} в высоком качестве!"
+                    caption=caption
                 )
+                
+                # Следующая отправка (повторный скан QR) пойдёт по file_id
+                set_photo_file_id(session_id, photo['id'], sent.document.file_id, sent.document.file_size)
         except Exception as e:
             print(f"Error sending photo: {e}")
             bot.send_message(
@@ -272,67 +329,68 @@ def handle_photo_or_document(message):
         if message.content_type == 'photo':
             # Обычное фото (сжатое Telegram)
             photo = message.photo[-1]  # Самое большое разрешение
-            file_info = bot.get_file(photo.file_id)
+            file_id, file_size = photo.file_id, photo.file_size
+            declared_size = (photo.width, photo.height)
             file_type_emoji = "📷"
             file_type_text = "Фото"
         elif message.content_type == 'document':
             # Документ (файл) - проверяем что это изображение
             document = message.document
             
-            if not document.mime_type or not document.mime_type.startswith('image/'):
+            file_name = (document.file_name or '').lower()
+            is_image = (document.mime_type or '').startswith('image/') or file_name.endswith(HEIF_EXTENSIONS)
+            
+            if not is_image:
                 bot.send_message(
                     message.chat.id,
                     "❌ Пожалуйста, отправьте изображение (JPG, PNG, HEIC)!"
                 )
                 return
             
-            file_info = bot.get_file(document.file_id)
+            file_id, file_size = document.file_id, document.file_size
+            declared_size = (None, None)  # размеры документа станут известны после скачивания
             file_type_emoji = "📎"
             file_type_text = "Файл"
         else:
             bot.send_message(message.chat.id, "❌ Неподдерживаемый тип файла.")
             return
         
-        # Скачиваем файл
-        downloaded_file = bot.download_file(file_info.file_path)
-        
-        # Открываем изображение с помощью PIL
-        img = Image.open(BytesIO(downloaded_file))
+        # Отказываем до скачивания - по размеру из сообщения
+        if file_size and file_size > MAX_UPLOAD_BYTES:
+            raise UploadTooLarge(f'file_size={file_size}')
         
-        # Конвертируем в RGB если нужно
-        if img.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-            img = background
-        
-        # Изменяем размер если очень большое (макс 4096px)
-        max_size = 4096
-        if max(img.size) > max_size:
-            ratio = max_size / max(img.size)
-            new_size = tuple(int(dim * ratio) for dim in img.size)
-            img = img.resize(new_size, Image.Resampling.LANCZOS)
+        photo_fields = {
+            'photo_type': 'uploaded',
+            'telegram_file_id': file_id,
+            'telegram_file_size': file_size,
+            'order_index': len(current_photos),
+        }
         
-        # Сохраняем в JPEG с качеством 95%
-        buffer = BytesIO()
-        img.save(buffer, format='JPEG', quality=95)
-        photo_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        photo_data_uri = f"data:image/jpeg;base64,{photo_base64}"
+        if LAZY_INGEST:
+            # Ничего не скачиваем: оригинал заберёт backend при первом показе
+            width, height = declared_size
+            image_bytes = None
+        else:
+            file_info = bot.get_file(file_id)
+            if file_info.file_size and file_info.file_size > MAX_UPLOAD_BYTES:
+                raise UploadTooLarge(f'file_info.file_size={file_info.file_size}')
+            
+            # Скачиваем файл потоком и декодируем прямо из него
+            # (декодирование, RGB, resize и JPEG - в пуле процессов)
+            with download_to_spool(file_info.file_path, BOT_TOKEN) as upload:
+                result = image_pipeline.process(upload)
+            width, height = result['width'], result['height']
+            image_bytes = result['data']
+            
+            if 'stats' in result:
+                print(f"📏 Photo normalized: {result['stats']}")
+            
+            photo_fields.update({key: value for key, value in result['metadata'].items() if value is not None})
         
-        # Получаем размеры
-        width, height = img.size
+        photo_fields.update({'width': width, 'height': height})
         
-        # Отправляем на backend
-        success = add_photo_to_session(session_id, {
-            'photo_type': 'uploaded',
-            'photo_data': photo_data_uri,
-            'telegram_file_id': file_info.file_id if message.content_type == 'photo' else message.document.file_id,
-            'telegram_file_size': file_info.file_size,
-            'width': width,
-            'height': height,
-            'order_index': len(current_photos)
-        })
+        # Отправляем на backend (байты JPEG как multipart файл, в ленивом режиме - только поля)
+        success = add_photo_to_session(session_id, photo_fields, image_bytes=image_bytes)
         
         if success:
             uploaded_count = len(current_photos) + 1
@@ -364,6 +422,38 @@ def handle_photo_or_document(message):
                 "❌ Ошибка при загрузке фото. Попробуйте ещё раз."
             )
     
+    except UploadTooLarge as e:
+        print(f"Upload rejected: {e}")
+        bot.send_message(
+            message.chat.id,
+            f"❌ Файл слишком большой (максимум {MAX_UPLOAD_BYTES // (1024 * 1024)} МБ).\n\n"
+            "Пожалуйста, отправьте фото меньшего размера."
+        )
+    
+    except ImageTooLarge as e:
+        print(f"Image rejected: {e}")
+        bot.send_message(
+            message.chat.id,
+            "❌ Изображение слишком большое.\n\n"
+            "Пожалуйста, отправьте фото меньшего разрешения."
+        )
+    
+    except UnsupportedImage as e:
+        print(f"Unsupported image: {e}")
+        bot.send_message(
+            message.chat.id,
+            "❌ Не удалось прочитать этот формат.\n\n"
+            "Пожалуйста, отправьте фото в JPG или PNG."
+        )
+    
+    except (PipelineBusy, PipelineTimeout) as e:
+        print(f"Image pipeline overloaded: {e}")
+        bot.send_message(
+            message.chat.id,
+            "⏳ Сейчас много фото в обработке.\n\n"
+            "Пожалуйста, отправьте это фото ещё раз через минуту."
+        )
+    
     except Exception as e:
         print(f"Error processing photo: {e}")
         bot.send_message(
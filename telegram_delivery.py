@@ -0,0 +1,94 @@
+"""
+Предзагрузка готовых фото в Telegram (file_id кэш)
+
+Как только фотобудка присылает готовое фото, backend один раз загружает
+его в служебный чат (TELEGRAM_STORAGE_CHAT_ID) и сохраняет полученный
+file_id в SessionPhoto.telegram_file_id. Бот потом отправляет фото гостю
+по file_id - без повторной загрузки байтов.
+
+file_id привязан к боту, поэтому здесь должен быть тот же токен, что и
+у telegram_bot.py. Если служебный чат не задан, file_id запоминается
+ботом при первой отправке (PATCH /api/session/<id>/photos/<photo_id>).
+
+Здесь же скачивание файлов по file_id для отложенной загрузки
+оригиналов (lazy_ingest); само потоковое скачивание - в telegram_download.
+"""
+import os
+import threading
+
+import telebot
+
+from models import db, SessionPhoto
+from telegram_download import MAX_UPLOAD_BYTES, UploadTooLarge, download_to_spool
+from write_queue import run_write
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+TELEGRAM_STORAGE_CHAT_ID = os.getenv('TELEGRAM_STORAGE_CHAT_ID')
+
+_bot = None
+
+
+def is_enabled():
+    """Предзагрузка включена только если есть и токен, и служебный чат"""
+    return bool(TELEGRAM_BOT_TOKEN and TELEGRAM_STORAGE_CHAT_ID)
+
+
+def _get_bot():
+    global _bot
+    if _bot is None:
+        _bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, threaded=False)
+    return _bot
+
+
+def download_file(file_id):
+    """Скачать файл по file_id (токеном backend'а), вернуть SpooledTemporaryFile"""
+    file_info = _get_bot().get_file(file_id)
+    if file_info.file_size and file_info.file_size > MAX_UPLOAD_BYTES:
+        raise UploadTooLarge(f'file_info.file_size={file_info.file_size}')
+    return download_to_spool(file_info.file_path)
+
+
+def prewarm_photo(app, photo_id):
+    """Загрузить фото в служебный чат и сохранить его file_id"""
+    with app.app_context():
+        photo = SessionPhoto.query.get(photo_id)
+        if not photo or photo.telegram_file_id:
+            return
+
+        data = photo.read_bytes()
+        if not data:
+            return
+
+        try:
+            message = _get_bot().send_document(
+                TELEGRAM_STORAGE_CHAT_ID,
+                document=data,
+                visible_file_name=f'photobooth_{photo.session_id}_{photo.id}.jpg',
+                disable_notification=True
+            )
+        except Exception as e:
+            print(f"❌ Telegram prewarm failed for photo {photo_id}: {e}", flush=True)
+            return
+
+        file_id = message.document.file_id
+        file_size = message.document.file_size
+
+        def write():
+            # Через очередь записи, как и остальные писатели; file_id,
+            # который бот успел сохранить сам, не перезаписываем
+            return db.session.execute(
+                db.update(SessionPhoto)
+                .where(SessionPhoto.id == photo_id, SessionPhoto.telegram_file_id.is_(None))
+                .values(telegram_file_id=file_id, telegram_file_size=file_size)
+            ).rowcount
+
+        if run_write(write):
+            print(f"✅ Photo {photo_id} prewarmed in Telegram: {file_id[:20]}...", flush=True)
+
+
+def prewarm_photo_async(app, photo_id):
+    """Предзагрузка в фоне, чтобы не задерживать ответ фотобудке"""
+    if not is_enabled():
+        return
+    thread = threading.Thread(target=prewarm_photo, args=(app, photo_id), daemon=True)
+    thread.start()
@@ -0,0 +1,53 @@
+"""
+Потоковое скачивание файлов Telegram
+
+Общий код бота (telegram_bot.py) и backend'а (telegram_delivery,
+lazy_ingest). Модуль не зависит от Flask и моделей, чтобы бот
+запускался отдельно от backend'а без его зависимостей.
+"""
+import os
+import tempfile
+
+import requests
+from telebot import apihelper
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+
+# Лимит размера скачиваемого файла (Bot API и так не отдаёт больше 20 МБ)
+MAX_UPLOAD_BYTES = int(float(os.getenv('MAX_UPLOAD_MB', '20')) * 1024 * 1024)
+# Файл скачивается в память до этого размера, дальше - во временный файл
+DOWNLOAD_SPOOL_BYTES = int(float(os.getenv('DOWNLOAD_SPOOL_MB', '2')) * 1024 * 1024)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    """Файл больше MAX_UPLOAD_BYTES"""
+
+
+def download_to_spool(file_path, token=None):
+    """Скачать файл Telegram потоком в SpooledTemporaryFile
+
+    Файл не держится в памяти целиком: после DOWNLOAD_SPOOL_BYTES данные
+    уходят на диск. Бросает UploadTooLarge если файл больше лимита
+    (даже если Telegram не сообщил размер заранее).
+    """
+    url = (apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(
+        token or TELEGRAM_BOT_TOKEN, file_path
+    )
+    spool = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_BYTES)
+
+    try:
+        with requests.get(url, stream=True, timeout=(10, 60)) as response:
+            response.raise_for_status()
+            received = 0
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                received += len(chunk)
+                if received > MAX_UPLOAD_BYTES:
+                    raise UploadTooLarge(f'{received} bytes received, limit {MAX_UPLOAD_BYTES}')
+                spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+
+    spool.seek(0)
+    return spool
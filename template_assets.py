@@ -0,0 +1,126 @@
+"""
+Реестр ассетов шаблонов печати (рамки, маски) в memory-mapped файлах
+
+Каждый ассет (PRINT_TEMPLATES_DIR/<template_name>/<asset>.png)
+декодируется один раз в "сырой" буфер пикселей и сохраняется в
+TEMPLATE_CACHE_DIR. Процессы открывают этот файл через mmap, поэтому
+все воркеры используют одну физическую копию из page cache, а
+повторное декодирование PNG не нужно даже после перезапуска.
+
+Имя кэш-файла содержит mtime и размер исходника: если файл шаблона
+поменялся на диске, при следующем обращении ассет перечитывается.
+"""
+import glob
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+from PIL import Image
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+PRINT_TEMPLATES_DIR = os.getenv('PRINT_TEMPLATES_DIR', os.path.join(basedir, 'templates'))
+TEMPLATE_CACHE_DIR = os.getenv('TEMPLATE_CACHE_DIR', os.path.join(basedir, 'storage', 'template_cache'))
+
+# Имя шаблона = имя папки: без "/", ".." и прочего, что уводит из PRINT_TEMPLATES_DIR
+TEMPLATE_NAME_PATTERN = re.compile(r'[\w-]+')
+
+
+def is_valid_template_name(template_name):
+    """Можно ли подставлять template_name в путь к файлам шаблона"""
+    return isinstance(template_name, str) and TEMPLATE_NAME_PATTERN.fullmatch(template_name) is not None
+
+
+class TemplateAssetRegistry:
+    """Декодированные ассеты шаблонов, общие для всех процессов"""
+
+    def __init__(self, templates_dir, cache_dir):
+        self.templates_dir = templates_dir
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._loaded = {}  # (template_name, asset, mode) -> (version, image)
+
+    @staticmethod
+    def _version(path):
+        """Версия исходника: меняется при любом изменении файла"""
+        stat = os.stat(path)
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def _prefix(self, template_name, asset, mode, version):
+        # Имя уже проверено в get(): оно попадает и в имя файла, и в glob
+        return os.path.join(self.cache_dir, f"{template_name}.{asset}.{mode}.{version}")
+
+    def _decode_to_cache(self, source_path, prefix, mode):
+        """Декодировать исходник и записать сырые пиксели в кэш-файл"""
+        image = Image.open(source_path).convert(mode)
+        width, height = image.size
+        target = f"{prefix}.{width}x{height}.raw"
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(image.tobytes())
+        # Атомарно: другие процессы видят либо целый файл, либо никакого
+        os.replace(tmp_path, target)
+
+        print(f"✅ Template asset decoded: {os.path.basename(target)}", flush=True)
+        return target
+
+    def _remove_stale(self, template_name, asset, mode, keep_prefix):
+        pattern = os.path.join(self.cache_dir, f"{glob.escape(f'{template_name}.{asset}.{mode}')}.*.raw")
+        for path in glob.glob(pattern):
+            if not path.startswith(keep_prefix):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # Windows: файл ещё замаплен другим процессом
+
+    @staticmethod
+    def _map(path, mode):
+        """Открыть кэш-файл как Image без копирования пикселей"""
+        size_part = path.rsplit('.', 2)[-2]
+        width, height = (int(value) for value in size_part.split('x'))
+
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return Image.frombuffer(mode, (width, height), buffer, 'raw', mode, 0, 1)
+
+    def get(self, template_name, asset, mode):
+        """Ассет шаблона как Image (только чтение) или None если файла нет
+
+        ValueError если template_name не имя папки шаблона (см.
+        is_valid_template_name) - иначе оно вывело бы путь за пределы
+        templates_dir/cache_dir.
+        """
+        if not is_valid_template_name(template_name):
+            raise ValueError(f'Invalid template name: {template_name!r}')
+
+        source_path = os.path.join(self.templates_dir, template_name, f"{asset}.png")
+        try:
+            version = self._version(source_path)
+        except FileNotFoundError:
+            return None
+
+        key = (template_name, asset, mode)
+        with self._lock:
+            loaded = self._loaded.get(key)
+            if loaded and loaded[0] == version:
+                return loaded[1]
+
+            prefix = self._prefix(template_name, asset, mode, version)
+            cached = glob.glob(f"{glob.escape(prefix)}.*.raw")
+            path = cached[0] if cached else self._decode_to_cache(source_path, prefix, mode)
+
+            image = self._map(path, mode)
+            self._loaded[key] = (version, image)
+
+            if loaded:
+                self._remove_stale(template_name, asset, mode, prefix)
+
+        return image
+
+
+template_asset_registry = TemplateAssetRegistry(PRINT_TEMPLATES_DIR, TEMPLATE_CACHE_DIR)
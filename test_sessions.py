@@ -3,6 +3,9 @@
 """
 import requests
 import json
+import threading
+from io import BytesIO
+from PIL import Image
 
 API_URL = "http://localhost:5000/api"
 
@@ -47,8 +50,191 @@ def test_add_photo(session_id):
         })
         
         assert response.status_code == 201
+        # Счётчики сессии приходят в том же ответе
+        assert response.json()['session']['uploaded_count'] == i + 1
         print(f"✅ Photo {i+1} added")
     
+    # После 3 фото сессия готова
+    session = requests.get(f"{API_URL}/session/{session_id}").json()
+    assert session['status'] == 'ready'
+    assert session['photos_count'] == 3
+    print(f"✅ Session ready with {session['uploaded_count']} photos")
+    
+    return True
+
+def test_add_photo_binary(session_id):
+    """Тест добавления фото без base64 (multipart и octet-stream)"""
+    print(f"\n3️⃣b Тест: Бинарная загрузка фото")
+    
+    # Минимальный JPEG заголовок - backend не декодирует загрузку
+    fake_jpeg = b'\xff\xd8\xff\xe0' + b'0' * 1024
+    
+    response = requests.post(
+        f"{API_URL}/session/{session_id}/photos",
+        data={"photo_type": "uploaded", "width": 1920, "height": 1080, "order_index": 3},
+        files={"photo": ("photo.jpg", fake_jpeg, "image/jpeg")}
+    )
+    assert response.status_code == 201
+    assert response.json()['photo']['photo_path']
+    print(f"✅ Multipart photo added")
+    
+    response = requests.post(
+        f"{API_URL}/session/{session_id}/result",
+        data=fake_jpeg,
+        headers={
+            "Content-Type": "application/octet-stream",
+            "X-Photo-Width": "1920",
+            "X-Photo-Height": "1080"
+        }
+    )
+    assert response.status_code == 201
+    assert response.json()['photo']['width'] == 1920
+    print(f"✅ Octet-stream result photo added")
+    
+    # Пустое тело не создаёт фото без байтов
+    uploaded_count = requests.get(f"{API_URL}/session/{session_id}").json()['uploaded_count']
+    response = requests.post(
+        f"{API_URL}/session/{session_id}/photos",
+        data=b'',
+        headers={"Content-Type": "application/octet-stream"}
+    )
+    assert response.status_code == 400
+    response = requests.post(
+        f"{API_URL}/session/{session_id}/photos",
+        data={"photo_type": "uploaded"},
+        files={"photo": ("photo.jpg", b'', "image/jpeg")}
+    )
+    assert response.status_code == 400
+    assert requests.get(f"{API_URL}/session/{session_id}").json()['uploaded_count'] == uploaded_count
+    print(f"✅ Empty uploads rejected")
+    
+    return True
+
+def test_add_photos_batch():
+    """Тест пакетной загрузки фото (одна транзакция, order_index от сервера)"""
+    print(f"\n3️⃣c Тест: Пакетная загрузка фото")
+    
+    session_id = test_create_session()
+    
+    response = requests.post(f"{API_URL}/session/{session_id}/photos/batch", json={
+        "photo_type": "uploaded",
+        "photos": [
+            {"photo_data": f"base64_photo_data_{i}", "width": 1920, "height": 1080}
+            for i in range(3)
+        ]
+    })
+    
+    assert response.status_code == 201
+    data = response.json()
+    assert [photo['order_index'] for photo in data['photos']] == [0, 1, 2]
+    assert data['session']['status'] == 'ready'
+    print(f"✅ Batch of 3 photos added, session ready")
+    
+    # Лимит 5 фото проверяется на весь пакет
+    response = requests.post(f"{API_URL}/session/{session_id}/photos/batch", json={
+        "photos": [{"photo_data": "x"}, {"photo_data": "y"}, {"photo_data": "z"}]
+    })
+    assert response.status_code == 400
+    print(f"✅ Batch over limit rejected")
+    
+    for photos in ("abc", [1, 2], {"photo_data": "x"}):
+        response = requests.post(f"{API_URL}/session/{session_id}/photos/batch", json={"photos": photos})
+        assert response.status_code == 400, photos
+    print(f"✅ Malformed photos list rejected")
+    
+    requests.delete(f"{API_URL}/session/{session_id}")
+    return True
+
+def _jpeg(color, size=(640, 480)):
+    """Настоящий JPEG - для сборки листа фото декодируются"""
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+def test_compose_print_sheet():
+    """Тест сборки листа для печати по шаблону"""
+    print(f"\n3️⃣d Тест: Сборка листа для печати")
+    
+    session_id = test_create_session()
+    for i, color in enumerate([(220, 40, 40), (40, 40, 220)]):
+        response = requests.post(
+            f"{API_URL}/session/{session_id}/photos",
+            data={"photo_type": "uploaded", "order_index": i},
+            files={"photo": ("photo.jpg", _jpeg(color), "image/jpeg")}
+        )
+        assert response.status_code == 201
+    
+    response = requests.post(f"{API_URL}/session/{session_id}/compose", json={
+        "template_name": "format_2",
+        "copy_count": 2
+    })
+    assert response.status_code == 201
+    data = response.json()
+    assert data['print']['template_name'] == "format_2"
+    assert data['print']['copy_count'] == 2
+    
+    # Лист 4x6 дюймов при 300 dpi
+    response = requests.get(f"{API_URL}/session/{session_id}/photos/{data['photo']['id']}/file")
+    assert response.status_code == 200
+    sheet = Image.open(BytesIO(response.content))
+    assert sheet.size == (1200, 1800)
+    print(f"✅ Sheet composed: {sheet.size[0]}x{sheet.size[1]}, timings {data['timings']}")
+    
+    response = requests.get(f"{API_URL}/session/{session_id}")
+    assert response.json()['result_count'] == 1
+    
+    # Имя шаблона подставляется в путь - только буквы, цифры, "_" и "-"
+    response = requests.post(f"{API_URL}/session/{session_id}/compose", json={"template_name": "../format_2"})
+    assert response.status_code == 400
+    response = requests.post(f"{API_URL}/session/{session_id}/compose", json={"template_name": "no_such_template"})
+    assert response.status_code == 404
+    print(f"✅ Invalid and unknown templates rejected")
+    
+    for photo_ids in (5, [], ["1"], [True]):
+        response = requests.post(f"{API_URL}/session/{session_id}/compose", json={
+            "template_name": "format_2", "photo_ids": photo_ids
+        })
+        assert response.status_code == 400, photo_ids
+        assert response.json()['success'] is False
+    print(f"✅ Malformed photo_ids rejected")
+    
+    requests.delete(f"{API_URL}/session/{session_id}")
+    return True
+
+def test_concurrent_uploads():
+    """Тест параллельной загрузки в одну сессию (лимит и order_index под блокировкой)"""
+    print(f"\n3️⃣e Тест: Параллельная загрузка фото")
+    
+    session_id = test_create_session()
+    fake_jpeg = b'\xff\xd8\xff\xe0' + b'1' * 1024
+    codes = []
+    
+    def upload(i):
+        # Все клиенты просят один и тот же order_index
+        response = requests.post(
+            f"{API_URL}/session/{session_id}/photos?include_data=0",
+            data={"photo_type": "uploaded", "order_index": 0},
+            files={"photo": (f"photo_{i}.jpg", fake_jpeg + bytes([i]), "image/jpeg")}
+        )
+        codes.append(response.status_code)
+    
+    threads = [threading.Thread(target=upload, args=(i,)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert sorted(codes) == [201] * 5 + [400] * 5, codes
+    
+    photos = requests.get(f"{API_URL}/session/{session_id}/photos?include_data=0").json()['photos']
+    assert sorted(photo['order_index'] for photo in photos) == [0, 1, 2, 3, 4]
+    
+    session = requests.get(f"{API_URL}/session/{session_id}").json()
+    assert session['uploaded_count'] == 5
+    assert session['status'] == 'ready'
+    print(f"✅ 10 parallel uploads: 5 accepted, order_index 0-4, session ready")
+    
+    requests.delete(f"{API_URL}/session/{session_id}")
     return True
 
 def test_get_photos(session_id):
@@ -113,6 +299,10 @@ def run_all_tests():
         
         # Тест 3: Добавление фото
         test_add_photo(session_id)
+        test_add_photo_binary(session_id)
+        test_add_photos_batch()
+        test_compose_print_sheet()
+        test_concurrent_uploads()
         
         # Тест 4: Получение фото
         test_get_photos(session_id)
@@ -0,0 +1,585 @@
+"""
+Тестирование хранения фото и схемы БД без запущенного backend'а
+
+В отличие от test_sessions.py сервер не нужен: приложение поднимается
+через Flask test client на временной SQLite БД и временном хранилище,
+поэтому можно "состарить" фото и проверить миграции на пустой БД.
+
+Запуск: python test_storage.py
+На PostgreSQL (пустая БД, пользователь с правом CREATE DATABASE для
+тестов миграций): TEST_DATABASE_URL=postgresql://... python test_storage.py
+"""
+import atexit
+import base64
+import os
+import shutil
+import threading
+import tempfile
+from datetime import datetime, timedelta
+from io import BytesIO
+from types import SimpleNamespace
+
+TEST_DIR = tempfile.mkdtemp(prefix='photobooth-test-')
+# И при запуске скриптом, и под pytest (run_all_tests там не вызывается)
+atexit.register(shutil.rmtree, TEST_DIR, ignore_errors=True)
+
+# Всё временное - до импорта модулей приложения (они читают env при импорте)
+# TEST_DATABASE_URL - прогнать те же тесты на PostgreSQL (пустая БД, например
+# postgresql://postgres@localhost/photobooth_test), иначе временная SQLite
+os.environ['DATABASE_URL'] = (
+    os.getenv('TEST_DATABASE_URL') or f"sqlite:///{os.path.join(TEST_DIR, 'photobooth.db')}"
+)
+os.environ['PHOTO_STORAGE_DIR'] = os.path.join(TEST_DIR, 'photos')
+os.environ['DERIVATIVE_CACHE_DIR'] = os.path.join(TEST_DIR, 'derivatives')
+os.environ['TEMPLATE_CACHE_DIR'] = os.path.join(TEST_DIR, 'template_cache')
+os.environ['MIGRATE_CHECKPOINT_PATH'] = os.path.join(TEST_DIR, 'migrate_photos.checkpoint.json')
+os.environ['BLOB_RELEASE_GRACE_MINUTES'] = '0'
+os.environ['IMAGE_WORKERS'] = '0'
+os.environ['WRITE_QUEUE'] = '0'
+
+import sqlalchemy as sa
+from PIL import Image
+
+from db_engine import configure_engine, database_url, engine_options
+from migrations import LATEST_VERSION, SchemaOutdated, check_schema, current_version, migrate
+
+
+def _engine(url):
+    engine = sa.create_engine(url, **engine_options(url))
+    configure_engine(engine)
+    return engine
+
+
+# app.py отказывается стартовать без миграций
+migrate(_engine(database_url()))
+
+from app import app
+import lazy_ingest
+import migrate_photos
+import session_routes
+import telegram_delivery
+from models import db, repair_photo_counters, Session, SessionPhoto
+from photo_storage import blob_store
+from write_queue import WriteQueue
+
+client = app.test_client()
+
+
+def make_jpeg(color=(200, 30, 30), size=(64, 48)):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def create_session():
+    response = client.post('/api/session/create', json={'type': 'upload'})
+    assert response.status_code == 201
+    return response.get_json()['session']['id']
+
+
+def add_photo(session_id, photo_type='uploaded', color=(200, 30, 30)):
+    response = client.post(
+        f'/api/session/{session_id}/photos',
+        data={'photo_type': photo_type, 'photo': (BytesIO(make_jpeg(color)), 'photo.jpg')},
+        content_type='multipart/form-data'
+    )
+    return response
+
+
+def test_retention_purge():
+    """Тест очистки байтов старых фото по политикам хранения"""
+    print("\n1️⃣  Тест: Retention - очистка старых фото")
+
+    old_session = create_session()
+    old_photo = add_photo(old_session, color=(10, 200, 10)).get_json()['photo']
+    fresh_session = create_session()
+    fresh_photo = add_photo(fresh_session, color=(10, 10, 200)).get_json()['photo']
+
+    # Фото старше RETENTION_UPLOADED_HOURS
+    with app.app_context():
+        photo = SessionPhoto.query.get(old_photo['id'])
+        photo.uploaded_at = datetime.utcnow() - timedelta(days=3)
+        db.session.commit()
+
+    response = client.post('/api/photos/retention?dry_run=1')
+    assert response.status_code == 200
+    report = response.get_json()
+    assert report['dry_run'] is True
+    assert report['purged']['uploaded'] == 1
+    assert blob_store.exists(old_photo['photo_path']), "dry_run не должен удалять файлы"
+    print(f"✅ Dry run: {report['purged']}")
+
+    response = client.post('/api/photos/retention')
+    report = response.get_json()
+    assert report['purged']['uploaded'] == 1
+    assert report['reclaimed_bytes'] > 0
+    assert not blob_store.exists(old_photo['photo_path'])
+
+    # Строка остаётся, байты - нет
+    response = client.get(f"/api/session/{old_session}/photos?include_data=0")
+    photos = response.get_json()['photos']
+    assert len(photos) == 1 and photos[0]['purged_at']
+    assert client.get(old_photo['file_url']).status_code == 410
+
+    # Свежее фото не тронуто
+    assert client.get(fresh_photo['file_url']).status_code == 200
+    print(f"✅ Purged old photo, reclaimed {report['reclaimed_bytes']} bytes, fresh photo kept")
+
+    # Повторный запуск ничего не находит
+    report = client.post('/api/photos/retention').get_json()
+    assert report['purged']['uploaded'] == 0
+    print("✅ Second run: nothing to purge")
+
+
+def test_migrate_photos_resume():
+    """Тест переноса base64 фото в blob store с продолжением по checkpoint"""
+    print("\n2️⃣  Тест: migrate_photos - перенос base64 и продолжение")
+
+    session_id = create_session()
+    originals = [make_jpeg((i * 80, 40, 40)) for i in range(3)]
+
+    # Старые строки: base64 в photo_data, без photo_path
+    with app.app_context():
+        rows = [
+            SessionPhoto(
+                session_id=session_id, photo_type='uploaded', order_index=i,
+                photo_data='data:image/jpeg;base64,' + base64.b64encode(data).decode()
+            )
+            for i, data in enumerate(originals)
+        ]
+        rows.append(SessionPhoto(session_id=session_id, photo_type='result', photo_data='not_an_image'))
+        db.session.add_all(rows)
+        db.session.commit()
+        ids = [row.id for row in rows]
+
+        # Первая пачка, затем "прерывание": прогресс только в checkpoint
+        last_id, migrated, skipped = migrate_photos.migrate_batch(ids[0] - 1, 1)
+        assert (last_id, migrated, skipped) == (ids[0], 1, 0)
+        migrate_photos.save_checkpoint({'last_id': last_id, 'migrated': migrated, 'skipped': skipped})
+
+        migrate_photos.run(batch_size=2, sleep=0, vacuum=False)
+        checkpoint = migrate_photos.load_checkpoint()
+        assert checkpoint['migrated'] == 3, checkpoint
+        assert checkpoint['skipped'] == 1, checkpoint
+
+        db.session.expire_all()
+        for photo_id, data in zip(ids, originals):
+            photo = SessionPhoto.query.get(photo_id)
+            assert photo.photo_path and photo.photo_data is None
+            assert blob_store.get(photo.photo_path) == data
+        junk = SessionPhoto.query.get(ids[-1])
+        assert junk.photo_path is None and junk.photo_data == 'not_an_image'
+    print(f"✅ Migrated {checkpoint['migrated']}, skipped {checkpoint['skipped']}, resumed from checkpoint")
+
+    # Перенесённое фото отдаётся как файл
+    response = client.get(f'/api/session/{session_id}/photos/{ids[0]}/file')
+    assert response.status_code == 200 and response.data == originals[0]
+    print("✅ Migrated photo served from blob store")
+
+
+def test_migrate_photos_purged_and_vacuum():
+    """Тест: очищенная во время пачки строка не оживает, vacuum освобождает страницы"""
+    print("\n2️⃣b Тест: migrate_photos - гонка с retention и incremental vacuum")
+
+    session_id = create_session()
+    data = make_jpeg((30, 160, 30))
+
+    with app.app_context():
+        photo = SessionPhoto(
+            session_id=session_id, photo_type='uploaded',
+            photo_data='data:image/jpeg;base64,' + base64.b64encode(data).decode()
+        )
+        db.session.add(photo)
+        db.session.commit()
+        photo_id = photo.id
+
+        # Retention очищает строку, пока пачка пишет файл
+        put = blob_store.put
+
+        def put_and_purge(payload):
+            db.session.execute(
+                db.update(SessionPhoto).where(SessionPhoto.id == photo_id)
+                .values(photo_data=None, purged_at=datetime.utcnow())
+            )
+            db.session.commit()
+            return put(payload)
+
+        blob_store.put = put_and_purge
+        try:
+            _, migrated, _ = migrate_photos.migrate_batch(photo_id - 1, 1)
+        finally:
+            blob_store.put = put
+
+        db.session.expire_all()
+        photo = SessionPhoto.query.get(photo_id)
+        assert migrated == 0
+        assert photo.photo_path is None and photo.purged_at is not None
+        print("✅ Purged row keeps photo_path NULL")
+
+        # Свободные страницы после удаления больших строк (только SQLite)
+        if not migrate_photos.is_sqlite():
+            print("⏭️  Incremental vacuum: SQLite only")
+            return
+        migrate_photos.enable_incremental_vacuum()
+        db.session.execute(db.text('CREATE TABLE vacuum_filler (payload BLOB)'))
+        db.session.execute(
+            db.text('INSERT INTO vacuum_filler VALUES (:payload)'),
+            [{'payload': os.urandom(3000)} for _ in range(1500)]
+        )
+        db.session.commit()
+        db.session.execute(db.text('DROP TABLE vacuum_filler'))
+        db.session.commit()
+        free_pages = db.session.execute(db.text('PRAGMA freelist_count')).scalar()
+        db.session.commit()
+        assert free_pages > migrate_photos.VACUUM_PAGES_PER_STEP
+
+        migrate_photos.incremental_vacuum(sleep=0)
+        assert db.session.execute(db.text('PRAGMA freelist_count')).scalar() == 0
+        db.session.commit()
+    print(f"✅ Incremental vacuum freed all {free_pages} pages")
+
+
+def test_lazy_ingest_purged_during_download():
+    """Тест отложенной загрузки: очищенное во время скачивания фото не оживает"""
+    print("\n2️⃣c Тест: lazy_ingest - гонка с retention")
+
+    session_id = create_session()
+    data = make_jpeg((160, 30, 160))
+    download_file = lazy_ingest.download_file
+
+    with app.app_context():
+        photos = [
+            SessionPhoto(session_id=session_id, photo_type='uploaded', order_index=i, telegram_file_id=f'file_{i}')
+            for i in range(2)
+        ]
+        db.session.add_all(photos)
+        db.session.commit()
+        ids = [photo.id for photo in photos]
+
+        def download(file_id, purge=None):
+            if purge:
+                db.session.execute(
+                    db.update(SessionPhoto).where(SessionPhoto.id == purge)
+                    .values(purged_at=datetime.utcnow())
+                )
+                db.session.commit()
+            return BytesIO(data)
+
+        try:
+            lazy_ingest.download_file = download
+            lazy_ingest.ensure_ingested(SessionPhoto.query.get(ids[0]))
+            lazy_ingest.download_file = lambda file_id: download(file_id, purge=ids[1])
+            lazy_ingest.ensure_ingested(SessionPhoto.query.get(ids[1]))
+        finally:
+            lazy_ingest.download_file = download_file
+
+        db.session.expire_all()
+        ingested, purged = (SessionPhoto.query.get(photo_id) for photo_id in ids)
+        assert ingested.photo_path and blob_store.exists(ingested.photo_path)
+        assert purged.photo_path is None and purged.purged_at is not None
+    print("✅ Ingested photo stored, photo purged during download stays purged")
+
+
+def test_write_queue_savepoints():
+    """Тест очереди записи: ошибка одной единицы не откатывает остальные в пачке"""
+    print("\n3️⃣  Тест: WriteQueue - SAVEPOINT на каждую единицу записи")
+
+    session_ids = [create_session() for _ in range(2)]
+
+    def rename(session_id, status):
+        Session.query.get(session_id).status = status
+        db.session.flush()
+        return session_id
+
+    def broken(session_id):
+        Session.query.get(session_id).status = 'broken'
+        db.session.flush()
+        raise RuntimeError('boom')
+
+    # Окно побольше - все три единицы попадают в одну пачку
+    write_queue = WriteQueue(app, window_ms=200)
+    try:
+        futures = [
+            write_queue.submit(rename, session_ids[0], 'ready'),
+            write_queue.submit(broken, session_ids[1]),
+            write_queue.submit(rename, session_ids[1], 'completed'),
+        ]
+        assert futures[0].result(timeout=10) == session_ids[0]
+        try:
+            futures[1].result(timeout=10)
+            assert False, "ошибка единицы должна дойти до вызывающего"
+        except RuntimeError:
+            pass
+        assert futures[2].result(timeout=10) == session_ids[1]
+    finally:
+        write_queue.shutdown()
+
+    with app.app_context():
+        statuses = [Session.query.get(session_id).status for session_id in session_ids]
+    assert statuses == ['ready', 'completed'], statuses
+    print(f"✅ Batch committed around the failed unit: {statuses}")
+
+
+def test_prewarm_through_write_queue():
+    """Тест предзагрузки в Telegram: file_id сохраняется через очередь записи"""
+    print("\n3️⃣c Тест: prewarm_photo пишет через WriteQueue")
+
+    session_id = create_session()
+    photo = add_photo(session_id, photo_type='result').get_json()['photo']
+    writer_threads = []
+
+    class FakeBot:
+        def send_document(self, chat_id, document, **kwargs):
+            return SimpleNamespace(document=SimpleNamespace(file_id='prewarmed_file_id', file_size=len(document)))
+
+    def on_write(fn):
+        # Единица записи должна выполняться в потоке писателя
+        def unit():
+            writer_threads.append(threading.current_thread().name)
+            return fn()
+        return unit
+
+    get_bot = telegram_delivery._get_bot
+    run_write = telegram_delivery.run_write
+    write_queue = WriteQueue(app)
+    app.extensions['write_queue'] = write_queue
+    try:
+        telegram_delivery._get_bot = FakeBot
+        telegram_delivery.run_write = lambda fn: run_write(on_write(fn))
+        telegram_delivery.prewarm_photo(app, photo['id'])
+    finally:
+        telegram_delivery._get_bot = get_bot
+        telegram_delivery.run_write = run_write
+        del app.extensions['write_queue']
+        write_queue.shutdown()
+
+    assert writer_threads == ['db-writer'], writer_threads
+    with app.app_context():
+        stored = db.session.get(SessionPhoto, photo['id'])
+        assert stored.telegram_file_id == 'prewarmed_file_id'
+        assert stored.telegram_file_size > 0
+    print("✅ file_id saved by the db-writer thread")
+
+
+def test_deleted_during_write():
+    """Тест: фото/сессию удалили между проверкой в запросе и записью - 404, а не 500"""
+    print("\n3️⃣b Тест: Удаление между проверкой и единицей записи")
+
+    session_id = create_session()
+    photo = add_photo(session_id).get_json()['photo']
+    run_write = session_routes.run_write
+
+    def delete_then_write(model, object_id):
+        def wrapper(fn, *args, **kwargs):
+            db.session.execute(db.delete(model).where(model.id == object_id))
+            db.session.commit()
+            return run_write(fn, *args, **kwargs)
+        return wrapper
+
+    try:
+        session_routes.run_write = delete_then_write(SessionPhoto, photo['id'])
+        response = client.patch(
+            f"/api/session/{session_id}/photos/{photo['id']}", json={'telegram_file_id': 'file_x'}
+        )
+        assert response.status_code == 404, response.status_code
+
+        session_routes.run_write = delete_then_write(Session, session_id)
+        response = client.put(f'/api/session/{session_id}', json={'status': 'ready'})
+        assert response.status_code == 404, response.status_code
+    finally:
+        session_routes.run_write = run_write
+    print("✅ PATCH photo and PUT session answer 404")
+
+
+def test_photo_counters():
+    """Тест счётчиков фото сессии: вставка, удаление через ORM, пересчёт"""
+    print("\n5️⃣  Тест: Счётчики фото сессии")
+
+    session_id = create_session()
+    for i in range(2):
+        assert add_photo(session_id, color=(i * 90, 90, 90)).status_code == 201
+    response = add_photo(session_id, photo_type='result')
+    assert response.get_json()['session']['result_count'] == 1
+
+    session = client.get(f'/api/session/{session_id}').get_json()
+    assert (session['uploaded_count'], session['result_count'], session['photos_count']) == (2, 1, 3)
+    print("✅ Counters after inserts: uploaded 2, result 1")
+
+    with app.app_context():
+        # Удаление через ORM уменьшает счётчик в той же транзакции
+        photo = SessionPhoto.query.filter_by(session_id=session_id, photo_type='uploaded').first()
+        db.session.delete(photo)
+        db.session.commit()
+        assert Session.query.get(session_id).uploaded_count == 1
+
+        # Массовое удаление мимо ORM - счётчик расходится до repair
+        SessionPhoto.query.filter_by(session_id=session_id, photo_type='result').delete()
+        db.session.commit()
+        assert Session.query.get(session_id).result_count == 1
+
+        assert repair_photo_counters(db.session) == 1
+        db.session.commit()
+        db.session.expire_all()
+        session = Session.query.get(session_id)
+        assert (session.uploaded_count, session.result_count) == (1, 0)
+        assert repair_photo_counters(db.session) == 0
+        db.session.commit()
+    print("✅ ORM delete decrements, repair_photo_counters fixes bulk deletes")
+
+    # Удаление сессии вместе с фото
+    assert client.delete(f'/api/session/{session_id}').status_code == 200
+
+
+def test_icc_profile_after_conversion():
+    """ICC профиль остаётся в файле только если режим не менялся"""
+    print("\n6️⃣  Тест: ICC профиль при перекодировании")
+
+    from PIL import ImageCms
+
+    import image_pipeline
+
+    srgb = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+
+    def normalized(mode, color, format='JPEG'):
+        buffer = BytesIO()
+        Image.new(mode, (300, 200), color).save(buffer, format=format, icc_profile=srgb)
+        result = image_pipeline.normalize_upload(buffer.getvalue())
+        assert not result['passthrough'], f"{mode} must be re-encoded"
+        return Image.open(BytesIO(result['data']))
+
+    rgb = normalized('RGB', (10, 20, 30), format='PNG')
+    assert rgb.info.get('icc_profile') == srgb, "RGB -> RGB must keep the profile"
+    print("✅ RGB source keeps its profile")
+
+    for mode, color in (('CMYK', (0, 255, 0, 0)), ('L', 128), ('RGBA', (10, 20, 30, 255))):
+        output = normalized(mode, color, format='PNG' if mode == 'RGBA' else 'JPEG')
+        assert output.mode == 'RGB'
+        assert not output.info.get('icc_profile'), f"{mode} -> RGB must not carry the source profile"
+    print("✅ CMYK, L and RGBA sources are written without the source profile")
+
+
+# Схема до миграций (как её создавал db.create_all в первых версиях);
+# {serial} - автоинкрементный id: INTEGER в SQLite, SERIAL в PostgreSQL
+LEGACY_SCHEMA = [
+    '''CREATE TABLE sessions (
+        id VARCHAR(36) PRIMARY KEY, kiosk_id INTEGER, type VARCHAR(20) NOT NULL,
+        status VARCHAR(20), created_at TIMESTAMP NOT NULL, expires_at TIMESTAMP NOT NULL,
+        completed_at TIMESTAMP, telegram_user_id BIGINT, telegram_username VARCHAR(100), data TEXT
+    )''',
+    '''CREATE TABLE session_photos (
+        id {serial} PRIMARY KEY, session_id VARCHAR(36) NOT NULL REFERENCES sessions (id),
+        photo_type VARCHAR(20) NOT NULL, photo_path VARCHAR(500), photo_data TEXT,
+        telegram_file_id VARCHAR(200), telegram_file_size INTEGER, uploaded_at TIMESTAMP NOT NULL,
+        width INTEGER, height INTEGER, order_index INTEGER
+    )''',
+]
+
+
+def _scratch_url(name):
+    """Отдельная пустая БД на той же СУБД, что и основная тестовая"""
+    url = sa.make_url(database_url())
+    if url.get_backend_name() == 'sqlite':
+        return f"sqlite:///{os.path.join(TEST_DIR, name + '.db')}"
+
+    database = f'{url.database}_{name}'
+    admin = sa.create_engine(url, isolation_level='AUTOCOMMIT')
+    with admin.connect() as conn:
+        conn.exec_driver_sql(f'DROP DATABASE IF EXISTS {database}')
+        conn.exec_driver_sql(f'CREATE DATABASE {database}')
+    admin.dispose()
+    return url.set(database=database).render_as_string(hide_password=False)
+
+
+def test_schema_migrations():
+    """Тест миграций: новая БД, старая БД без schema_version, повторный запуск"""
+    print("\n4️⃣  Тест: Миграции схемы БД")
+
+    # Пустая БД: приложение не должно стартовать
+    engine = _engine(_scratch_url('empty'))
+    try:
+        check_schema(engine)
+        assert False, "check_schema должен отказать без миграций"
+    except SchemaOutdated:
+        pass
+    assert migrate(engine) == LATEST_VERSION
+    assert check_schema(engine) == LATEST_VERSION
+    print(f"✅ New database created at version {LATEST_VERSION}")
+
+    # Старая БД с данными
+    engine = _engine(_scratch_url('legacy'))
+    serial = 'SERIAL' if engine.dialect.name == 'postgresql' else 'INTEGER'
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            conn.exec_driver_sql(statement.format(serial=serial))
+        conn.execute(sa.text(
+            "INSERT INTO sessions (id, type, status, created_at, expires_at) "
+            "VALUES ('legacy', 'upload', 'ready', :now, :now)"
+        ), {'now': now})
+        for photo_type in ('uploaded', 'uploaded', 'result'):
+            conn.execute(sa.text(
+                "INSERT INTO session_photos (session_id, photo_type, uploaded_at) "
+                "VALUES ('legacy', :photo_type, :now)"
+            ), {'photo_type': photo_type, 'now': now})
+
+    assert current_version(engine) is None
+    assert migrate(engine) == LATEST_VERSION
+    assert check_schema(engine) == LATEST_VERSION
+
+    inspector = sa.inspect(engine)
+    indexes = {index['name'] for table in ('sessions', 'session_photos', 'payments')
+               for index in inspector.get_indexes(table)}
+    for name in ('ix_sessions_expires_at', 'ix_session_photos_session_type_order',
+                 'ix_payments_status_created_at', 'ix_payments_create_time'):
+        assert name in indexes, f"нет индекса {name}"
+
+    with engine.connect() as conn:
+        counters = conn.execute(sa.text(
+            "SELECT uploaded_count, result_count FROM sessions WHERE id = 'legacy'"
+        )).one()
+    assert tuple(counters) == (2, 1), counters
+    print(f"✅ Legacy database upgraded: indexes created, counters {tuple(counters)}")
+
+    # Повторный запуск ничего не применяет
+    with engine.connect() as conn:
+        stamps = conn.execute(sa.text("SELECT count(*) FROM schema_version")).scalar()
+    assert migrate(engine) == LATEST_VERSION
+    with engine.connect() as conn:
+        assert conn.execute(sa.text("SELECT count(*) FROM schema_version")).scalar() == stamps
+    print("✅ Second migrate run is a no-op")
+
+
+def run_all_tests():
+    """Запустить все тесты"""
+    print("=" * 60)
+    print("🧪 ТЕСТИРОВАНИЕ ХРАНЕНИЯ ФОТО И СХЕМЫ БД")
+    print("=" * 60)
+
+    try:
+        test_retention_purge()
+        test_migrate_photos_resume()
+        test_migrate_photos_purged_and_vacuum()
+        test_lazy_ingest_purged_during_download()
+        test_write_queue_savepoints()
+        test_deleted_during_write()
+        test_prewarm_through_write_queue()
+        test_schema_migrations()
+        test_photo_counters()
+        test_icc_profile_after_conversion()
+
+        print("\n" + "=" * 60)
+        print("✅ ВСЕ ТЕСТЫ ПРОЙДЕНЫ!")
+        print("=" * 60)
+
+    except AssertionError as e:
+        print(f"\n❌ ТЕСТ ПРОВАЛЕН: {e}")
+        return False
+    except Exception as e:
+        print(f"\n❌ ОШИБКА: {e}")
+        return False
+
+    return True
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if run_all_tests() else 1)
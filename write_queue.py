@@ -0,0 +1,153 @@
+"""
+Очередь записи в БД с одним писателем и групповым commit'ом
+
+Обычно каждый запрос делает свой db.session.commit(): отдельный fsync и
+борьба за блокировку SQLite с другими писателями. В режиме WRITE_QUEUE=1
+запросы передают "единицу записи" (функцию) одному потоку-писателю.
+Он собирает единицы за короткое окно (WRITE_QUEUE_WINDOW_MS), выполняет
+каждую в своём SAVEPOINT и фиксирует всю пачку одним COMMIT.
+Чтения по-прежнему идут параллельно в потоках запросов.
+
+Единица записи:
+- выполняется в другом потоке и в другой сессии SQLAlchemy - объекты
+  загружаются заново по id, request/g недоступны (всё нужное передаётся
+  аргументами);
+- возвращает обычные данные (dict, id), а не ORM объекты;
+- исключение откатывает только её SAVEPOINT и пробрасывается вызывающему.
+
+Перед ожиданием run_write() завершает читающую транзакцию запроса, поэтому
+объекты, загруженные до записи, нужно перечитать (db.session.refresh).
+
+Без WRITE_QUEUE run_write() выполняет функцию сразу и делает commit.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+
+from models import db
+
+WRITE_QUEUE_ENABLED = os.getenv('WRITE_QUEUE', '0') == '1'
+# Сколько ждать следующие единицы после первой, прежде чем фиксировать
+WRITE_QUEUE_WINDOW_MS = float(os.getenv('WRITE_QUEUE_WINDOW_MS', '2'))
+WRITE_QUEUE_MAX_BATCH = int(os.getenv('WRITE_QUEUE_MAX_BATCH', '64'))
+# Сколько запрос ждёт результат своей записи
+WRITE_QUEUE_TIMEOUT = float(os.getenv('WRITE_QUEUE_TIMEOUT', '30'))
+
+
+class WriteQueue:
+    """Поток-писатель: единицы записи по порядку, один COMMIT на пачку"""
+
+    def __init__(self, app, window_ms=WRITE_QUEUE_WINDOW_MS, max_batch=WRITE_QUEUE_MAX_BATCH):
+        self.app = app
+        self.window = window_ms / 1000
+        self.max_batch = max(max_batch, 1)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+        print(f"✅ Write queue started: window {window_ms} ms, batch up to {self.max_batch}", flush=True)
+
+    def submit(self, fn, *args, **kwargs):
+        """Поставить единицу записи в очередь, вернуть Future с её результатом"""
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first):
+        """Пачка: первая единица + всё, что придёт за окно (до max_batch)"""
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                unit = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if unit is None:
+                self._queue.put(None)  # остановка - после этой пачки
+                break
+            batch.append(unit)
+        return batch
+
+    def _run(self):
+        while True:
+            unit = self._queue.get()
+            if unit is None:
+                return
+            batch = self._collect(unit)
+            with self.app.app_context():
+                self._apply(batch)
+
+    def _apply(self, batch):
+        outcomes = []
+        try:
+            if db.engine.dialect.name == 'sqlite':
+                # pysqlite сам не открывает транзакцию до первого DML, а
+                # RELEASE первого SAVEPOINT вне транзакции сделал бы COMMIT.
+                # IMMEDIATE - сразу берём блокировку записи на всю пачку
+                db.session.connection().exec_driver_sql('BEGIN IMMEDIATE')
+
+            for future, fn, args, kwargs in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                savepoint = db.session.begin_nested()
+                try:
+                    result = fn(*args, **kwargs)
+                    savepoint.commit()
+                except Exception as e:
+                    savepoint.rollback()
+                    outcomes.append((future, None, e))
+                else:
+                    outcomes.append((future, result, None))
+
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Write queue batch of {len(batch)} failed: {e}", flush=True)
+            for future, _, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+def init_write_queue(app):
+    """Запустить поток-писатель если включён WRITE_QUEUE"""
+    if WRITE_QUEUE_ENABLED and 'write_queue' not in app.extensions:
+        app.extensions['write_queue'] = WriteQueue(app)
+    return app.extensions.get('write_queue')
+
+
+def run_write(fn, *args, **kwargs):
+    """Выполнить единицу записи и вернуть её результат
+
+    Через очередь писателя, если она запущена, иначе сразу в текущей
+    сессии с commit (rollback при ошибке).
+    """
+    write_queue = current_app.extensions.get('write_queue')
+    if write_queue is not None:
+        # Пока ждём писателя, читающая транзакция запроса не должна держать
+        # соединение из пула - иначе под нагрузкой писателю его не хватит.
+        # Загруженные объекты при этом просто перечитаются при обращении
+        db.session.rollback()
+        return write_queue.submit(fn, *args, **kwargs).result(timeout=WRITE_QUEUE_TIMEOUT)
+
+    try:
+        result = fn(*args, **kwargs)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result